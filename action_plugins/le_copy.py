@@ -5,17 +5,426 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import fcntl
+import hashlib
 import json
 import os
 import stat
+import struct
+import tarfile
 import tempfile
+import time
+import zlib
+from contextlib import contextmanager
 
 from ansible.constants import mk_boolean as boolean
 from ansible.errors import AnsibleError, AnsibleFileNotFound
+from ansible.module_utils.basic import human_to_bytes
 from ansible.module_utils._text import to_bytes, to_native, to_text
 from ansible.plugins.action import ActionBase
 from ansible.utils.hashing import checksum
 
+try:
+    import sqlite3
+    HAS_SQLITE = True
+except ImportError:
+    HAS_SQLITE = False
+
+# 增量传输的文件头，与library/le_copy.py保持一致
+DELTA_MAGIC = b'LEDELTA1'
+READ_SIZE = 1024 * 1024
+LITERAL_FLUSH = 1024 * 1024
+# 未匹配区域逐字节滚动校验，约1秒/MB，超过此大小的差异直接全量传输
+DELTA_MAX_LITERAL = 8 * 1024 * 1024
+# 开头这么多数据里一个块都没有匹配时认为文件完全不同
+DELTA_PROBE = 2 * 1024 * 1024
+
+# 本地校验和缓存，所有fork和每次运行共享
+CACHE_PATH = os.environ.get('ANSIBLE_LE_COPY_CACHE', '~/.ansible/le_copy/checksums.db')
+CACHE_SIZE = int(os.environ.get('ANSIBLE_LE_COPY_CACHE_SIZE', 64 * 1024 * 1024))
+
+
+def stat_key(st):
+    ''' the part of a stat result that must not change for a cached checksum to stay valid '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_ino, st.st_size, mtime_ns)
+
+
+class ChecksumCache(object):
+    '''
+    sqlite backed cache of checksums of local source files, shared by all forks
+    and runs. An entry is keyed by (path, kind) and is only used while the inode,
+    size and mtime of the file are unchanged. The least recently used entries are
+    dropped once the stored values grow past the size cap.
+    '''
+
+    def __init__(self, path=CACHE_PATH, size=CACHE_SIZE):
+        self.path = os.path.expanduser(path)
+        self.size = size
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            dirname = os.path.dirname(self.path)
+            try:
+                os.makedirs(dirname, 0o700)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+            db = sqlite3.connect(self.path, timeout=30)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS checksums (path TEXT, kind TEXT, ino INTEGER, '
+                           'size INTEGER, mtime_ns INTEGER, value TEXT, bytes INTEGER, atime REAL, '
+                           'PRIMARY KEY (path, kind))')
+                db.execute('CREATE INDEX IF NOT EXISTS checksums_atime ON checksums (atime)')
+            self._db = db
+        return self._db
+
+    def get(self, path, kind, compute):
+        ''' return the cached value of kind for path, calling compute(path) on a miss '''
+        b_path = to_bytes(path, errors='surrogate_or_strict')
+        key = stat_key(os.stat(b_path))
+        if not HAS_SQLITE:
+            return compute(path)
+        try:
+            db = self._connect()
+            row = db.execute('SELECT ino, size, mtime_ns, value, atime FROM checksums WHERE path = ? AND kind = ?',
+                             (to_text(path), kind)).fetchone()
+            now = time.time()
+            if row is not None and tuple(row[:3]) == key:
+                # 命中时更新访问时间，一分钟内不重复写入
+                if now - row[4] > 60:
+                    with db:
+                        db.execute('UPDATE checksums SET atime = ? WHERE path = ? AND kind = ?',
+                                   (now, to_text(path), kind))
+                return json.loads(row[3])
+        except (OSError, IOError, sqlite3.Error):
+            # 缓存目录或数据库不可用时直接计算
+            return compute(path)
+
+        value = compute(path)
+        # 计算期间文件被修改，不写入缓存
+        if stat_key(os.stat(b_path)) != key:
+            return value
+        data = json.dumps(value)
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (to_text(path), kind) + key + (data, len(data), now))
+                self._evict(db)
+        except (OSError, IOError, sqlite3.Error):
+            pass
+        return value
+
+    def _evict(self, db):
+        total = db.execute('SELECT COALESCE(SUM(bytes), 0) FROM checksums').fetchone()[0]
+        if total <= self.size:
+            return
+        # 按最近最少使用删除，直到低于上限的90%
+        excess = total - self.size * 9 // 10
+        for rowid, size in db.execute('SELECT rowid, bytes FROM checksums ORDER BY atime').fetchall():
+            db.execute('DELETE FROM checksums WHERE rowid = ?', (rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+
+
+CACHE = ChecksumCache()
+
+# 大于此大小的传输受max_transfers限制
+LARGE_TRANSFER = 8 * 1024 * 1024
+
+
+class Throttle(object):
+    '''
+    Bandwidth limits shared by every le_copy running on the controller, kept
+    in lock files next to the checksum cache: a byte rate for all transfers,
+    one per remote host and a cap on concurrent large transfers. Rates are
+    enforced by booking each transfer on a virtual clock, so transfers start
+    no faster than the link budget allows and forks queue instead of racing.
+    '''
+
+    def __init__(self, host, bwlimit=0, host_bwlimit=0, max_transfers=0):
+        self.path = os.path.dirname(CACHE.path)
+        self.host = host
+        self.bwlimit = bwlimit
+        self.host_bwlimit = host_bwlimit
+        self.max_transfers = max_transfers
+        self.waited = 0.0
+
+    def _reserve(self, name, nbytes, rate):
+        ''' book nbytes on the rate limit name, returns the time the transfer may start '''
+        f = open(os.path.join(self.path, name), 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                next_free = float(f.read() or 0)
+            except ValueError:
+                next_free = 0
+            start = max(time.time(), next_free)
+            f.seek(0)
+            f.truncate()
+            f.write(repr(start + nbytes / float(rate)))
+        finally:
+            f.close()
+        return start
+
+    @contextmanager
+    def transfer(self, nbytes):
+        ''' wait for a free slot and for the rate limits before sending nbytes '''
+        if not (self.bwlimit or self.host_bwlimit or self.max_transfers):
+            yield
+            return
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+        start = time.time()
+        slot = None
+        while self.max_transfers and nbytes >= LARGE_TRANSFER and slot is None:
+            for index in range(self.max_transfers):
+                f = open(os.path.join(self.path, 'slot-%d' % index), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    f.close()
+                    continue
+                slot = f
+                break
+            else:
+                time.sleep(0.2)
+
+        try:
+            begin = time.time()
+            if self.bwlimit:
+                begin = max(begin, self._reserve('bw-global', nbytes, self.bwlimit))
+            if self.host_bwlimit:
+                begin = max(begin, self._reserve('bw-host-%s' % self.host, nbytes, self.host_bwlimit))
+            if begin > time.time():
+                time.sleep(begin - time.time())
+            self.waited += time.time() - start
+            yield
+        finally:
+            if slot is not None:
+                slot.close()
+
+# 已经压缩过的文件格式，compress=auto时不再压缩
+COMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.lz4', '.zip', '.jar', '.war',
+                         '.ear', '.whl', '.7z', '.rar', '.rpm', '.deb', '.png', '.jpg', '.jpeg', '.gif',
+                         '.webp', '.mp3', '.mp4', '.mkv', '.pdf')
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ', b'PK\x03\x04', b'7z\xbc\xaf', b'\x28\xb5\x2f\xfd',
+                    b'\x89PNG', b'\xff\xd8\xff', b'%PDF', b'\xed\xab\xee\xdb')
+COMPRESS_SAMPLE = 64 * 1024
+COMPRESS_MIN_SIZE = 4096
+
+
+def compression_for(b_source, compress):
+    ''' the compression (gzip, zlib or None) to use for b_source with the compress option '''
+    if compress in ('gzip', 'zlib'):
+        return compress
+    if compress != 'auto' and not boolean(compress):
+        return None
+    if os.path.getsize(b_source) < COMPRESS_MIN_SIZE:
+        return None
+    if os.path.splitext(b_source)[1].lower() in [to_bytes(ext) for ext in COMPRESSED_EXTENSIONS]:
+        return None
+    f = open(b_source, 'rb')
+    try:
+        sample = f.read(COMPRESS_SAMPLE)
+    finally:
+        f.close()
+    for magic in COMPRESSED_MAGIC:
+        if sample.startswith(magic):
+            return None
+    # 试压缩文件开头，压缩率不到10%的不值得压缩
+    if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+        return None
+    return 'gzip'
+
+
+def compress_file(b_source, out, compression, level):
+    ''' stream b_source through zlib into the file object out '''
+    wbits = zlib.MAX_WBITS
+    if compression == 'gzip':
+        wbits += 16
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    f = open(b_source, 'rb')
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            out.write(compressor.compress(data))
+        out.write(compressor.flush())
+    finally:
+        f.close()
+
+
+def chunk_checksums(b_source, chunk_size):
+    ''' sha1 of every chunk_size piece of b_source '''
+    sums = []
+    f = open(b_source, 'rb')
+    try:
+        while True:
+            digest = hashlib.sha1()
+            remaining = chunk_size
+            while remaining:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                remaining -= len(data)
+            if remaining == chunk_size:
+                break
+            sums.append(digest.hexdigest())
+            if remaining:
+                break
+    finally:
+        f.close()
+    return sums
+
+
+def local_manifest(b_root):
+    ''' {relpath: [size, mode, sha1]} of everything under b_root, directories have no size and sha1 '''
+    manifest = {}
+    for b_dirpath, b_dirnames, b_filenames in os.walk(b_root, followlinks=True):
+        for b_name in b_dirnames + b_filenames:
+            b_path = os.path.join(b_dirpath, b_name)
+            relpath = to_text(os.path.relpath(b_path, b_root), errors='surrogate_or_strict').replace(os.sep, '/')
+            try:
+                st = os.stat(b_path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                manifest[relpath] = [None, stat.S_IMODE(st.st_mode), None]
+            elif stat.S_ISREG(st.st_mode):
+                path = to_text(b_path, errors='surrogate_or_strict')
+                manifest[relpath] = [st.st_size, stat.S_IMODE(st.st_mode), CACHE.get(path, 'sha1', checksum)]
+    return manifest
+
+
+class DeltaWriter(object):
+    ''' encodes literal data and runs of consecutive remote blocks into a delta stream '''
+
+    def __init__(self, out, block_size):
+        self.out = out
+        self.first = None
+        self.count = 0
+        self.literal_bytes = 0
+        self.matched_blocks = 0
+        out.write(DELTA_MAGIC + struct.pack('>I', block_size))
+
+    def literal(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self.out.write(b'L' + struct.pack('>I', len(data)) + bytes(data))
+        self.literal_bytes += len(data)
+
+    def copy(self, index):
+        self.matched_blocks += 1
+        if self.first is not None and self.first + self.count == index:
+            self.count += 1
+            return
+        self._flush_copy()
+        self.first, self.count = index, 1
+
+    def close(self):
+        self._flush_copy()
+
+    def _flush_copy(self):
+        if self.first is not None:
+            self.out.write(b'C' + struct.pack('>II', self.first, self.count))
+            self.first = None
+
+
+def make_delta(b_source, signatures, out, max_literal):
+    '''
+    Write an rsync style delta of b_source against the block signatures of
+    the remote file to out. Blocks that line up are found with zlib at C
+    speed, the rolling checksum only runs over regions that do not match.
+    Returns None as soon as more than max_literal bytes would be sent, or
+    when DELTA_PROBE bytes of literal data went by without a single match.
+    '''
+    block_size = signatures['block_size']
+    table = {}
+    for index, (weak, strong) in enumerate(signatures['blocks']):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    writer = DeltaWriter(out, block_size)
+    f = open(b_source, 'rb')
+    try:
+        buf = bytearray()
+        pos = start = 0
+        eof = False
+        weak = None
+        while True:
+            # 窗口不足一个块时，先写出未匹配的数据再读取新数据
+            if not eof and len(buf) - pos < block_size:
+                writer.literal(buf[start:pos])
+                if writer.literal_bytes > max_literal:
+                    return None
+                del buf[:pos]
+                pos = start = 0
+                data = f.read(READ_SIZE)
+                if data:
+                    buf.extend(data)
+                else:
+                    eof = True
+                continue
+
+            n = min(block_size, len(buf) - pos)
+            if n == 0:
+                break
+            if weak is None:
+                weak = zlib.adler32(bytes(buf[pos:pos + n])) & 0xffffffff
+                a, b = weak & 0xffff, weak >> 16
+
+            candidates = table.get(weak)
+            if candidates:
+                index = candidates.get(hashlib.sha1(bytes(buf[pos:pos + n])).hexdigest()[:16])
+                if index is not None:
+                    writer.literal(buf[start:pos])
+                    writer.copy(index)
+                    pos = start = pos + n
+                    weak = None
+                    continue
+
+            # 文件末尾不足一个块且没有匹配
+            if n < block_size:
+                writer.literal(buf[start:])
+                break
+
+            # 窗口向后滚动一个字节
+            if pos + n < len(buf):
+                out_byte, in_byte = buf[pos], buf[pos + n]
+                a = (a - out_byte + in_byte) % 65521
+                b = (b - n * out_byte + a - 1) % 65521
+                weak = (b << 16) | a
+            else:
+                weak = None
+            pos += 1
+            if pos - start >= LITERAL_FLUSH:
+                writer.literal(buf[start:pos])
+                start = pos
+                if writer.literal_bytes > max_literal:
+                    return None
+                if not writer.matched_blocks and writer.literal_bytes >= DELTA_PROBE:
+                    return None
+        writer.close()
+    finally:
+        f.close()
+    return writer
+
 
 class ActionModule(ActionBase):
 
@@ -40,10 +449,19 @@ class ActionModule(ActionBase):
         result['failed'] = True
         if source is None or dest is None:
             result['msg'] = "src and dest are required"
-        elif source is not None and source.endswith("/"):
-            result['msg'] = "src must be a file"
         else:
-            del result['failed']
+            # 带宽限制，所有fork共享
+            try:
+                self._throttle = Throttle(self._play_context.remote_addr,
+                    bwlimit=human_to_bytes(self._task.args.get('bwlimit') or 0),
+                    host_bwlimit=human_to_bytes(self._task.args.get('host_bwlimit') or 0),
+                    max_transfers=int(self._task.args.get('max_transfers') or 0))
+                if min(self._throttle.bwlimit, self._throttle.host_bwlimit, self._throttle.max_transfers) < 0:
+                    raise ValueError("must not be negative")
+            except (TypeError, ValueError) as e:
+                result['msg'] = "invalid bwlimit, host_bwlimit or max_transfers: %s" % to_text(e)
+            else:
+                del result['failed']
 
         if result.get('failed'):
             return result
@@ -54,6 +472,7 @@ class ActionModule(ActionBase):
             return result
 
         # 找到source的路径地址
+        trailing_slash = source.endswith(os.sep)
         try:
             source = self._find_needle('files', source)
         except AnsibleError as e:
@@ -61,29 +480,31 @@ class ActionModule(ActionBase):
             result['msg'] = to_text(e)
             return result
 
-        # 判断是否是目录，如果是跳出返回
+        # 目录递归同步
         if os.path.isdir(to_bytes(source, errors='surrogate_or_strict')):
-            result['failed'] = True
-            result['msg'] = 'src must be a file'
-            return result
+            if isinstance(dest, list):
+                result['failed'] = True
+                result['msg'] = "a list of dest is only supported when src is a file"
+                return result
+            if not trailing_slash:
+                dest = self._connection._shell.join_path(dest, os.path.basename(source.rstrip(os.sep)))
+            return self._copy_tree(source, dest, force, tmp, task_vars, result)
 
         changed = False
         module_return = dict(changed=False)
 
-        # 创建临时目录
-        if tmp is None or "-tmp-" not in tmp:
-            tmp = self._make_tmp_path()
-
         # 5. 获取本地文件，不存在抛出异常
         try:
             source_full = self._loader.get_real_file(source)
             source_rel = os.path.basename(source)
         except AnsibleFileNotFound as e:
             result['failed'] = True
-            result['msg'] = "could not find src=%s, %s" % (source_full, e)
-            self._remove_tmp_path(tmp)
+            result['msg'] = "could not find src=%s, %s" % (source, e)
             return result
 
+        # 多个目标路径，只上传一次
+        if isinstance(dest, list):
+            return self._copy_many(source, source_full, dest, force, tmp, task_vars, result)
 
         # 获取远程文件信息
         if self._connection._shell.path_has_trailing_slash(dest):
@@ -95,7 +516,6 @@ class ActionModule(ActionBase):
 
         # 如果是目录，则返回
         if dest_status['exists'] and dest_status['isdir']:
-           self._remove_tmp_path(tmp)
            result['failed'] = True
            result['msg'] = "can not use content with a dir as dest"
            return result
@@ -104,36 +524,67 @@ class ActionModule(ActionBase):
         if dest_status['exists'] and not force:
           return result
 
+        # 远程文件与本地文件一致时，不创建临时目录也不传送文件
+        local_checksum = CACHE.get(source_full, 'sha1', checksum)
+        if dest_status['exists'] and dest_status['checksum'] == local_checksum:
+            result.update(dict(dest=dest_file, src=source, checksum=local_checksum, changed=False))
+            self._update_stats(result, skipped=1)
+            return result
+
+        # 远程缓存中已有相同内容时直接从缓存安装
+        cached = self._install_from_cache(dest_file, local_checksum, tmp, task_vars)
+        if cached is not None:
+            result.update(cached)
+            if not cached.get('failed'):
+                result['src'] = source
+                self._update_stats(result, cached=1)
+            return result
+
+        # 创建临时目录
+        if tmp is None or "-tmp-" not in tmp:
+            tmp = self._make_tmp_path()
+
         # 定义拷贝到远程的文件路径
         tmp_src = self._connection._shell.join_path(tmp, 'source')
 
-        # 传送文件
+        # 目标文件已存在时尝试增量传输
+        module_return = transfer = None
+        if boolean(self._task.args.get('delta', False)) and dest_status['exists']:
+            module_return, transfer = self._copy_delta(source_full, dest_file, tmp, task_vars, local_checksum)
 
-        remote_path = None
-        remote_path = self._transfer_file(source_full, tmp_src)
+        # 大文件分块上传，断线重试时只补传缺失的分块；check模式会在远端写分块，走普通传输
+        chunk_size = int(self._task.args.get('chunk_size', 0))
+        if module_return is None and not self._play_context.check_mode and 0 < chunk_size < os.path.getsize(to_bytes(source_full, errors='surrogate_or_strict')):
+            module_return, transfer = self._copy_chunked(source_full, dest_file, local_checksum, chunk_size,
+                                                         tmp, task_vars)
 
-        # 确保我们的文件具有执行权限
-        if remote_path:
-            self._fixup_perms2((tmp, remote_path))
+        if module_return is None:
+            # 传送文件
+            transfer = self._transfer_source(source_full, tmp, tmp_src)
 
-        # 运行remote_copy 模块
-        new_module_args = self._task.args.copy()
-        new_module_args.update(
-            dict(
-                src=tmp_src,
-                dest=dest,
-                original_basename=source_rel,
+            # 运行remote_copy 模块
+            new_module_args = self._task.args.copy()
+            new_module_args.update(
+                dict(
+                    src=tmp_src,
+                    dest=dest,
+                    original_basename=source_rel,
+                    checksum=local_checksum,
+                    compression=transfer['compression'],
+                )
             )
-        )
 
-        module_return = self._execute_module(module_name='le_copy',
-            module_args=new_module_args, task_vars=task_vars,
-            tmp=tmp)
+            module_return = self._execute_module(module_name='le_copy',
+                module_args=new_module_args, task_vars=task_vars,
+                tmp=tmp)
 
         # 判断运行结果
         if module_return.get('failed'):
             result.update(module_return)
+            self._remove_tmp_path(tmp)
             return result
+        module_return['transfer'] = self._with_throughput(transfer)
+        self._update_stats(module_return, transferred=1)
         if module_return.get('changed'):
             changed = True
 
@@ -147,3 +598,319 @@ class ActionModule(ActionBase):
         
         # 返回结果
         return result
+
+    def _transfer_payload(self, local_path, remote_path):
+        '''
+        _transfer_file within the bandwidth limits of the task, only for the file data
+        itself; module payloads are not throttled so probes never wait behind bulk uploads
+        '''
+        with self._throttle.transfer(os.path.getsize(local_path)):
+            return super(ActionModule, self)._transfer_file(local_path, remote_path)
+
+    def _with_throughput(self, transfer):
+        ''' add the time spent waiting for bandwidth and the throughput in bytes/s to transfer '''
+        wait = round(self._throttle.waited, 3)
+        busy = max(transfer['elapsed'] - wait, 0.001)
+        transfer.update(wait=wait, throughput=int(transfer['bytes'] / busy))
+        return transfer
+
+    def _update_stats(self, result, **counters):
+        '''
+        Add run wide counters (le_copy_skipped, le_copy_transferred, ...) to the
+        custom stats, they are summed over all hosts and tasks of the run and
+        shown in the recap when show_custom_stats is enabled.
+        '''
+        data = dict(('le_copy_%s' % k, v) for k, v in counters.items())
+        result['ansible_stats'] = dict(data=data, per_host=False, aggregate=True)
+
+    def _copy_tree(self, source, dest, force, tmp, task_vars, result):
+        '''
+        Sync the directory source to dest with a fixed number of round-trips:
+        one module call to find the stale entries, one archive transfer and
+        one module call to unpack it.
+        '''
+        b_source = to_bytes(source, errors='surrogate_or_strict')
+        manifest = local_manifest(b_source)
+        file_count = len([v for v in manifest.values() if v[2] is not None])
+
+        # 远程对比清单，只返回缺失或变化的条目
+        remote = self._execute_module(module_name='le_copy',
+            module_args=dict(dest=dest, manifest=manifest, force=force),
+            task_vars=task_vars, tmp=tmp)
+        if remote.get('failed'):
+            result.update(remote)
+            return result
+
+        stale = remote['stale']
+        stale_files = [p for p in stale if manifest[p][2] is not None]
+        if not stale:
+            result.update(dict(dest=dest, src=source, files=[], changed=False))
+            self._update_stats(result, skipped=file_count)
+            return result
+
+        if tmp is None or "-tmp-" not in tmp:
+            tmp = self._make_tmp_path()
+
+        # 把需要更新的文件打包成一个归档传送
+        compress = self._task.args.get('compress', 'no')
+        if compress in ('auto', 'gzip', 'zlib') or boolean(compress):
+            mode, kwargs = 'w:gz', dict(compresslevel=int(self._task.args.get('compress_level', 6)))
+        else:
+            mode, kwargs = 'w', dict()
+        fd, archive_path = tempfile.mkstemp(prefix='le_copy')
+        try:
+            os.close(fd)
+            # 与 local_manifest 一致跟随符号链接, 远端只接受普通文件和目录
+            tar = tarfile.open(archive_path, mode, dereference=True, **kwargs)
+            try:
+                for relpath in stale:
+                    tar.add(os.path.join(b_source, to_bytes(relpath, errors='surrogate_or_strict')),
+                            arcname=relpath, recursive=False)
+            finally:
+                tar.close()
+
+            tmp_src = self._connection._shell.join_path(tmp, 'source.tar')
+            start = time.time()
+            remote_path = self._transfer_payload(archive_path, tmp_src)
+            transfer = dict(mode='archive', compression=mode == 'w:gz' and 'gzip' or None,
+                            bytes=os.path.getsize(archive_path),
+                            size=sum(manifest[p][0] for p in stale_files),
+                            elapsed=round(time.time() - start, 3))
+        finally:
+            os.unlink(archive_path)
+
+        if remote_path:
+            self._fixup_perms2((tmp, remote_path))
+
+        module_return = self._execute_module(module_name='le_copy',
+            module_args=dict(src=tmp_src, dest=dest, archive=True),
+            task_vars=task_vars, tmp=tmp)
+        self._remove_tmp_path(tmp)
+
+        result.update(module_return)
+        if not module_return.get('failed'):
+            result['src'] = source
+            result['transfer'] = self._with_throughput(transfer)
+            self._update_stats(result, skipped=file_count - len(stale_files), transferred=len(stale_files))
+        return result
+
+    def _copy_many(self, source, source_full, dests, force, tmp, task_vars, result):
+        '''
+        Copy one file to several paths on the host: a single module call finds
+        the destinations that differ, the file is uploaded once and installed
+        into each of them by a second module call.
+        '''
+        source_rel = os.path.basename(source)
+        shell = self._connection._shell
+        dest_files = []
+        for dest in dests:
+            if shell.path_has_trailing_slash(dest):
+                dest_files.append(shell.join_path(dest, source_rel))
+            else:
+                dest_files.append(shell.join_path(dest))
+
+        local_checksum = CACHE.get(source_full, 'sha1', checksum)
+        remote = self._execute_module(module_name='le_copy',
+            module_args=dict(dest=dest_files, checksum=local_checksum, force=force, probe=True),
+            task_vars=task_vars, tmp=tmp)
+        if remote.get('failed'):
+            result.update(remote)
+            return result
+
+        stale = remote['stale']
+        results = dict((d, dict(dest=d, changed=False, checksum=local_checksum)) for d in dest_files)
+        transfer = None
+        cached = None
+        if stale:
+            cached = self._install_from_cache(stale, local_checksum, tmp, task_vars)
+            if cached is not None and cached.get('failed'):
+                result.update(cached)
+                return result
+        if cached is not None:
+            for item in cached['results']:
+                results[item['dest']] = item
+        elif stale:
+            if tmp is None or "-tmp-" not in tmp:
+                tmp = self._make_tmp_path()
+            tmp_src = shell.join_path(tmp, 'source')
+            transfer = self._transfer_source(source_full, tmp, tmp_src)
+
+            module_return = self._execute_module(module_name='le_copy',
+                module_args=self._cache_args(src=tmp_src, dest=stale, force=force, checksum=local_checksum,
+                                             compression=transfer['compression']),
+                task_vars=task_vars, tmp=tmp)
+            self._remove_tmp_path(tmp)
+            if module_return.get('failed'):
+                result.update(module_return)
+                return result
+            for item in module_return['results']:
+                results[item['dest']] = item
+
+        results = [results[d] for d in dest_files]
+        result.update(dict(dest=dest_files, src=source, checksum=local_checksum, results=results,
+                           changed=any(item['changed'] for item in results)))
+        if transfer is not None:
+            result['transfer'] = self._with_throughput(transfer)
+        if cached is not None:
+            result['cache_hit'] = True
+            self._update_stats(result, skipped=len(dest_files) - len(stale), cached=len(stale))
+        else:
+            self._update_stats(result, skipped=len(dest_files) - len(stale), transferred=len(stale))
+        return result
+
+    def _cache_args(self, **module_args):
+        ''' module_args plus the remote_cache options of the task '''
+        for name in ('remote_cache', 'remote_cache_size'):
+            if self._task.args.get(name) is not None:
+                module_args[name] = self._task.args[name]
+        return module_args
+
+    def _install_from_cache(self, dest, local_checksum, tmp, task_vars):
+        '''
+        Install dest from the remote_cache entry of local_checksum. Returns the
+        module result on a hit or a failure, None when the file has to be sent.
+        '''
+        if not self._task.args.get('remote_cache'):
+            return None
+        module_return = self._execute_module(module_name='le_copy',
+            module_args=self._cache_args(dest=dest, checksum=local_checksum, from_cache=True),
+            task_vars=task_vars, tmp=tmp)
+        if not module_return.get('failed') and not module_return.get('cache_hit'):
+            return None
+        return module_return
+
+    def _copy_chunked(self, source_full, dest_file, local_checksum, chunk_size, tmp, task_vars):
+        '''
+        Resumable upload: the remote host keeps the chunks it already has next to
+        dest_file, only the missing ones are sent, each followed by a module call
+        that checks and keeps it, and a last call assembles and verifies the file.
+        '''
+        b_source = to_bytes(source_full, errors='surrogate_or_strict')
+        sums = CACHE.get(source_full, 'chunks:%d' % chunk_size, lambda path: chunk_checksums(b_source, chunk_size))
+        args = dict(dest=dest_file, checksum=local_checksum, chunk_size=chunk_size, chunks=sums)
+
+        remote = self._execute_module(module_name='le_copy', module_args=dict(args),
+                                      task_vars=task_vars, tmp=tmp)
+        if remote.get('failed'):
+            return remote, None
+
+        tmp_chunk = self._connection._shell.join_path(tmp, 'chunk')
+        sent = 0
+        start = time.time()
+        f = open(b_source, 'rb')
+        try:
+            for index in remote['missing']:
+                # 把分块写到本地临时文件再传送
+                fd, chunk_path = tempfile.mkstemp(prefix='le_copy')
+                try:
+                    out = os.fdopen(fd, 'wb')
+                    try:
+                        f.seek(index * chunk_size)
+                        remaining = chunk_size
+                        while remaining:
+                            data = f.read(min(READ_SIZE, remaining))
+                            if not data:
+                                break
+                            out.write(data)
+                            remaining -= len(data)
+                    finally:
+                        out.close()
+                    remote_path = self._transfer_payload(chunk_path, tmp_chunk)
+                    sent += chunk_size - remaining
+                finally:
+                    os.unlink(chunk_path)
+                if remote_path:
+                    self._fixup_perms2((tmp, remote_path))
+
+                module_return = self._execute_module(module_name='le_copy',
+                    module_args=dict(args, src=tmp_chunk, chunk_index=index),
+                    task_vars=task_vars, tmp=tmp)
+                if module_return.get('failed'):
+                    return module_return, None
+        finally:
+            f.close()
+        elapsed = round(time.time() - start, 3)
+
+        module_return = self._execute_module(module_name='le_copy',
+            module_args=self._cache_args(assemble=True, **args),
+            task_vars=task_vars, tmp=tmp)
+        return module_return, dict(mode='chunked', bytes=sent, size=os.path.getsize(b_source),
+                                   chunks=len(sums), chunks_sent=len(remote['missing']), elapsed=elapsed)
+
+    def _transfer_source(self, source_full, tmp, tmp_src):
+        ''' send source_full to tmp_src, compressed when asked to, and describe the transfer '''
+        b_source = to_bytes(source_full, errors='surrogate_or_strict')
+        compression = compression_for(b_source, self._task.args.get('compress', 'no'))
+        start = time.time()
+        if compression:
+            remote_path, sent = self._transfer_compressed(b_source, tmp_src, compression)
+        else:
+            remote_path = self._transfer_payload(source_full, tmp_src)
+            sent = os.path.getsize(b_source)
+        transfer = dict(mode='full', compression=compression, bytes=sent,
+                        size=os.path.getsize(b_source), elapsed=round(time.time() - start, 3))
+
+        # 确保我们的文件具有执行权限
+        if remote_path:
+            self._fixup_perms2((tmp, remote_path))
+        return transfer
+
+    def _transfer_compressed(self, b_source, remote_path, compression):
+        ''' compress b_source into a local spool file and send it, returns (remote path, bytes sent) '''
+        fd, spool_path = tempfile.mkstemp(prefix='le_copy')
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                compress_file(b_source, out, compression, int(self._task.args.get('compress_level', 6)))
+            finally:
+                out.close()
+            return self._transfer_payload(spool_path, remote_path), os.path.getsize(spool_path)
+        finally:
+            os.unlink(spool_path)
+
+    def _copy_delta(self, source_full, dest_file, tmp, task_vars, local_checksum):
+        '''
+        Send only the blocks of source_full that differ from dest_file.
+        Returns (None, None) when a full copy should be done instead.
+        '''
+        b_source = to_bytes(source_full, errors='surrogate_or_strict')
+        size = os.path.getsize(b_source)
+
+        # 获取远程文件的块签名
+        remote = self._execute_module(module_name='le_copy',
+            module_args=dict(dest=dest_file, signatures=True,
+                             block_size=self._task.args.get('block_size', 0)),
+            task_vars=task_vars, tmp=tmp)
+        if remote.get('failed'):
+            return None, None
+
+        # 在本地生成增量文件，不比源文件小时放弃
+        fd, delta_path = tempfile.mkstemp(prefix='le_copy')
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                writer = make_delta(b_source, remote['signatures'], out, min(size // 2, DELTA_MAX_LITERAL))
+            finally:
+                out.close()
+            delta_size = os.path.getsize(delta_path)
+            if writer is None or delta_size >= size:
+                return None, None
+
+            tmp_delta = self._connection._shell.join_path(tmp, 'delta')
+            start = time.time()
+            remote_path = self._transfer_payload(delta_path, tmp_delta)
+            elapsed = round(time.time() - start, 3)
+        finally:
+            os.unlink(delta_path)
+
+        if remote_path:
+            self._fixup_perms2((tmp, remote_path))
+
+        module_return = self._execute_module(module_name='le_copy',
+            module_args=self._cache_args(dest=dest_file, patch=tmp_delta, checksum=local_checksum),
+            task_vars=task_vars, tmp=tmp)
+
+        # 重建后的文件校验失败时退回到完整传输
+        if module_return.get('delta_mismatch'):
+            return None, None
+        return module_return, dict(mode='delta', bytes=delta_size, size=size, elapsed=elapsed)
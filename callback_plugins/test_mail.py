@@ -1,104 +1,214 @@
+# -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import os
-import smtplib
 import json
+import smtplib
+import socket
+import threading
+import time
 
+from ansible.module_utils.six import string_types, text_type
+from ansible.module_utils.six.moves import queue
 from ansible.plugins.callback import CallbackBase
-from email import encoders
 from email.header import Header
 from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
 
-def _format_addr(s):
-name, addr = parseaddr(s)
-return formataddr(( \
-    Header(name, 'utf-8').encode(), \
-    addr.encode('utf-8') if isinstance(addr, unicode) else addr))
-
-def mail(subject='Ansible error mail', sender=None, to=None, body=None):
-
-if sender is None:
-    sender='<root>'
-if to is None:
-    to='to@test.com'
-if body is None:
-    body = subject
+SMTP_HOST = 'smtp.test.com'
+SMTP_PORT = 25
+SMTP_USER = 'user@test.com'
+SMTP_PASSWORD = 'test'
+SMTP_TIMEOUT = 10
+FROM_ADDR = 'from@test.com'
+TO_ADDR = 'to@test.com'
+# 待发送邮件队列的长度, 队列满时丢弃新邮件, 不阻塞任务执行
+QUEUE_SIZE = 1000
+# playbook 结束时等待队列发完的最长秒数
+FLUSH_TIMEOUT = 60
 
-from_addr = 'from@test.com'
 
-msg = MIMEText(body, 'plain', 'utf-8')
-msg['From'] = _format_addr(u'%s <%s>' % sender,from_addr)
-msg['To'] = _format_addr(u'管理员 <%s>' % to)
-msg['Subject'] = Header(subject, 'utf-8').encode()
+def _format_addr(s):
+    name, addr = parseaddr(s)
+    return formataddr((
+        Header(name, 'utf-8').encode(),
+        addr.encode('utf-8') if isinstance(addr, text_type) and str is bytes else addr))
+
+
+def message(subject='Ansible error mail', sender=None, to=None, body=None):
+    """
+    生成邮件
+    :return: (发件人, 收件人列表, 邮件内容)
+    """
+    if sender is None:
+        sender = 'root'
+    if to is None:
+        to = TO_ADDR
+    if body is None:
+        body = subject
+
+    msg = MIMEText(body, 'plain', 'utf-8')
+    msg['From'] = _format_addr(u'%s <%s>' % (sender, FROM_ADDR))
+    msg['To'] = _format_addr(u'管理员 <%s>' % to)
+    msg['Subject'] = Header(subject, 'utf-8').encode()
+    return FROM_ADDR, [to], msg.as_string()
+
+
+class Mailer(object):
+    """
+    后台线程发送邮件, 复用一个已登录的 SMTP 连接, 连接断开时重连
+    """
+
+    def __init__(self, display):
+        self.display = display
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.thread = None
+        self.smtp = None
+        self.dropped = 0
+
+    def put(self, mail):
+        """
+        把邮件放入队列, 不等待发送
+        :param mail: message() 生成的邮件
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            self.queue.put_nowait(mail)
+        except queue.Full:
+            self.dropped += 1
+
+    def worker(self):
+        while True:
+            mail = self.queue.get()
+            if mail is None:
+                self.close()
+                return
+            try:
+                self.send(mail)
+            except Exception as e:
+                self.display.warning('test_mail: unable to send mail: %s' % e)
+
+    def connect(self):
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        smtp.login(SMTP_USER, SMTP_PASSWORD)
+        return smtp
+
+    def send(self, mail):
+        # 复用的连接可能已被服务端断开, 重连后再发一次
+        for attempt in range(2):
+            try:
+                if self.smtp is None:
+                    self.smtp = self.connect()
+                self.smtp.sendmail(*mail)
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """
+        等待队列中的邮件发完并关闭连接
+        :param timeout: 最长等待秒数
+        """
+        if self.thread is None:
+            return
+        deadline = time.time() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(max(deadline - time.time(), 0))
+        if self.thread.is_alive():
+            self.display.warning('test_mail: %d mails not sent within %d seconds' % (self.queue.qsize(), timeout))
+        self.thread = None
+        if self.dropped:
+            self.display.warning('test_mail: %d mails dropped, the queue was full' % self.dropped)
+            self.dropped = 0
 
-smtp = smtplib.SMTP('smtp.test.com', 25) 
-smtp.login('user@test.com','test')
-smtp.sendmail(from_addr, [to], msg.as_string())
-smtp.quit()
 
 class CallbackModule(CallbackBase):
-"""
-This Ansible callback plugin mails errors to interested parties.
-"""
-CALLBACK_VERSION = 2.0
-CALLBACK_TYPE = 'notification'
-CALLBACK_NAME = 'test_mail'
-CALLBACK_NEEDS_WHITELIST = False
-
-def v2_runner_on_failed(self, res, ignore_errors=False):
-
-    host = res._host.get_name()
-
-    if ignore_errors:
-        return
-    sender = '"Ansible: %s"' % host
-    attach = res._task.action
-    if 'invocation' in res._result:
-        attach = "%s:  %s" % (res._result['invocation']['module_name'], json.dumps(res._result['invocation']['module_args']))
-
-    subject = 'Failed: %s' % attach
-    body = 'The following task failed for host ' + host + ':\n\n%s\n\n' % attach
-
-    if 'stdout' in res._result.keys() and res._result['stdout']:
-        subject = res._result['stdout'].strip('\r\n').split('\n')[-1]
-        body += 'with the following output in standard output:\n\n' + res._result['stdout'] + '\n\n'
-    if 'stderr' in res._result.keys() and res._result['stderr']:
-        subject = res._result['stderr'].strip('\r\n').split('\n')[-1]
-        body += 'with the following output in standard error:\n\n' + res._result['stderr'] + '\n\n'
-    if 'msg' in res._result.keys() and res._result['msg']:
-        subject = res._result['msg'].strip('\r\n').split('\n')[0]
-        body += 'with the following message:\n\n' + res._result['msg'] + '\n\n'
-    body += 'A complete dump of the error:\n\n' + self._dump_results(res._result)
-    mail(sender=sender, subject=subject, body=body)
-
-def v2_runner_on_unreachable(self, result):
-
-    host = result._host.get_name()
-    res = result._result
-
-    sender = '"Ansible: %s" <root>' % host
-    if isinstance(res, string_types):
-        subject = 'Unreachable: %s' % res.strip('\r\n').split('\n')[-1]
-        body = 'An error occurred for host ' + host + ' with the following message:\n\n' + res
-    else:
-        subject = 'Unreachable: %s' % res['msg'].strip('\r\n').split('\n')[0]
-        body = 'An error occurred for host ' + host + ' with the following message:\n\n' + \
-               res['msg'] + '\n\nA complete dump of the error:\n\n' + str(res)
-    mail(sender=sender, subject=subject, body=body)
-
-def v2_runner_on_async_failed(self, result):
-
-    host = result._host.get_name()
-    res = result._result
-
-    sender = '"Ansible: %s" <root>' % host
-    if isinstance(res, string_types):
-        subject = 'Async failure: %s' % res.strip('\r\n').split('\n')[-1]
-        body = 'An error occurred for host ' + host + ' with the following message:\n\n' + res
-    else:
-        subject = 'Async failure: %s' % res['msg'].strip('\r\n').split('\n')[0]
-        body = 'An error occurred for host ' + host + ' with the following message:\n\n' + \
-               res['msg'] + '\n\nA complete dump of the error:\n\n' + str(res)
-    mail(sender=sender, subject=subject, body=body)
+    """
+    This Ansible callback plugin mails errors to interested parties.
+    """
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'test_mail'
+    CALLBACK_NEEDS_WHITELIST = False
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+        self.mailer = Mailer(self._display)
+
+    def mail(self, **kwargs):
+        self.mailer.put(message(**kwargs))
+
+    def v2_runner_on_failed(self, res, ignore_errors=False):
+
+        host = res._host.get_name()
+
+        if ignore_errors:
+            return
+        sender = '"Ansible: %s"' % host
+        attach = res._task.action
+        if 'invocation' in res._result:
+            attach = "%s:  %s" % (res._result['invocation']['module_name'], json.dumps(res._result['invocation']['module_args']))
+
+        subject = 'Failed: %s' % attach
+        body = 'The following task failed for host ' + host + ':\n\n%s\n\n' % attach
+
+        if 'stdout' in res._result.keys() and res._result['stdout']:
+            subject = res._result['stdout'].strip('\r\n').split('\n')[-1]
+            body += 'with the following output in standard output:\n\n' + res._result['stdout'] + '\n\n'
+        if 'stderr' in res._result.keys() and res._result['stderr']:
+            subject = res._result['stderr'].strip('\r\n').split('\n')[-1]
+            body += 'with the following output in standard error:\n\n' + res._result['stderr'] + '\n\n'
+        if 'msg' in res._result.keys() and res._result['msg']:
+            subject = res._result['msg'].strip('\r\n').split('\n')[0]
+            body += 'with the following message:\n\n' + res._result['msg'] + '\n\n'
+        body += 'A complete dump of the error:\n\n' + self._dump_results(res._result)
+        self.mail(sender=sender, subject=subject, body=body)
+
+    def v2_runner_on_unreachable(self, result):
+
+        host = result._host.get_name()
+        res = result._result
+
+        sender = '"Ansible: %s"' % host
+        if isinstance(res, string_types):
+            subject = 'Unreachable: %s' % res.strip('\r\n').split('\n')[-1]
+            body = 'An error occurred for host ' + host + ' with the following message:\n\n' + res
+        else:
+            subject = 'Unreachable: %s' % res['msg'].strip('\r\n').split('\n')[0]
+            body = 'An error occurred for host ' + host + ' with the following message:\n\n' + \
+                   res['msg'] + '\n\nA complete dump of the error:\n\n' + str(res)
+        self.mail(sender=sender, subject=subject, body=body)
+
+    def v2_runner_on_async_failed(self, result):
+
+        host = result._host.get_name()
+        res = result._result
+
+        sender = '"Ansible: %s"' % host
+        if isinstance(res, string_types):
+            subject = 'Async failure: %s' % res.strip('\r\n').split('\n')[-1]
+            body = 'An error occurred for host ' + host + ' with the following message:\n\n' + res
+        else:
+            subject = 'Async failure: %s' % res['msg'].strip('\r\n').split('\n')[0]
+            body = 'An error occurred for host ' + host + ' with the following message:\n\n' + \
+                   res['msg'] + '\n\nA complete dump of the error:\n\n' + str(res)
+        self.mail(sender=sender, subject=subject, body=body)
+
+    def v2_playbook_on_stats(self, stats):
+        self.mailer.flush()
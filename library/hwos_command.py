@@ -14,12 +14,25 @@ description:
 options:
   command:
     description:
-      - HUAWEI network devices command
-    required: true
+      - HUAWEI network devices command, several lines are run one after another and
+        the run stops at the first line the device rejects.
+      - one of I(command) or I(commands) is required.
+    required: false
+  commands:
+    description:
+      - list of commands, each one is read up to the next prompt and checked for errors on its own.
+      - the per command output is returned in C(stdout), C(stdout_lines) and C(command_results).
+    required: false
+  stop_on_error:
+    description:
+      - stop running I(commands) at the first command the device rejects.
+    required: false
+    default: no
   shost:
     description:
       - remote network devices ip address
-    required: true
+      - required unless I(hosts) is given.
+    required: false
   sport:
     description:
       - remote network devices ssh port
@@ -27,17 +40,98 @@ options:
     default: 22
   suser:
     description:
-      - remote network devices ssh user
-    required: true
+      - remote network devices ssh user, default for the devices in I(hosts)
+    required: false
   spass:
     description:
-      - remote network devices ssh user password
-    required: true
+      - remote network devices ssh user password, default for the devices in I(hosts)
+    required: false
+  hosts:
+    description:
+      - run the command on several devices at once instead of I(shost).
+      - each item is an address or a dict with C(shost) and optionally C(sport), C(suser) and C(spass);
+        missing keys fall back to the module options.
+      - per device results are returned in C(results) and the task fails if any device failed.
+    required: false
+  forks:
+    description:
+      - how many devices of I(hosts) are worked on concurrently.
+    required: false
+    default: 10
+  device_timeout:
+    description:
+      - seconds a single device of I(hosts) may take in total before it is reported as timed out
+        and its connection is closed.
+    required: false
+    default: 300
   save:
     description:
       - save current configuration
+      - with I(config_diff) the configuration is only saved when it changed.
+    required: false
+    default: no
+  config_diff:
+    description:
+      - compare C(display current-configuration) before and after the commands, return the
+        added and removed lines in C(config_diff) and report changed only when they differ.
+      - the configuration after the commands is kept gzip compressed in
+        C(~/.ansible/hwos/snapshots), one file per device and port.
+    required: false
+    default: no
+  config_baseline:
+    description:
+      - where the configuration before the commands comes from. C(cache) uses the snapshot kept
+        by the previous run and only reads the device when there is none, C(device) always reads it.
+      - C(cache) misses changes made on the device outside of this module since the previous run.
+    required: false
+    default: device
+    choices: ['device', 'cache']
+  timeout:
+    description:
+      - seconds to wait for the ssh connection and for the device prompt after each command line
+    required: false
+    default: 30
+  output_file:
+    description:
+      - stream the output of the commands to this local file instead of returning it in stdout,
+        memory use stays flat whatever the size of the output.
+      - with I(hosts), C({host}) in the path is replaced by the device address.
+      - the result has C(output) with the path, size and sha1 of the file, stdout is empty.
+    required: false
+  output_limit:
+    description:
+      - keep only the last I(output_limit) characters of the output of each command in memory,
+        C(truncated) in the result tells whether anything was dropped.
+    required: false
+  parse:
+    description:
+      - parse the output of common display commands on the device and return the rows in C(parsed)
+        instead of the raw text; their stdout is empty. C(display interface brief),
+        C(display ip interface brief), C(display vlan), C(display mac-address) and
+        C(display lldp neighbor brief) are parsed, abbreviations such as C(dis int br) included.
+      - the output is parsed line by line as it is read, other commands are returned as usual.
     required: false
     default: no
+  trace:
+    description:
+      - write a transcript of everything sent to and received from the device to this local file,
+        one line per read or write with its timestamp, for offline analysis of slow devices.
+      - with I(hosts), C({host}) in the path is replaced by the device address.
+    required: false
+  persistent:
+    description:
+      - keep the authenticated shell open in a local session broker so that later tasks against the
+        same shost, sport and suser skip the ssh login.
+      - the broker is a daemon started on first use, listening on C(~/.ansible/hwos/broker.sock)
+        (C(ANSIBLE_HWOS_DIR) overrides the directory) and exiting once it has no sessions left.
+      - a reused shell is brought back to the user view before the command runs.
+    required: false
+    default: no
+  persistent_ttl:
+    description:
+      - seconds an unused session stays open in the broker.
+    required: false
+    default: 300
 author:
     - "Lework"
 '''
@@ -61,6 +155,18 @@ EXAMPLES = """
         spass: "{{ spass }}"
         command: display version
 
+    - name: display version on the whole access layer
+      hwos_command:
+        suser: "{{ suser }}"
+        spass: "{{ spass }}"
+        forks: 20
+        hosts:
+          - 192.168.77.140
+          - 192.168.77.141
+          - shost: 192.168.77.142
+            sport: 2222
+        command: display version
+
     - name: add vlan 800 and int 0/0/11
       hwos_command:
         sport: "{{ sport }}"
@@ -76,12 +182,33 @@ EXAMPLES = """
           port link-type access
           vlan 800
           port GigabitEthernet 0/0/12
+
+    - name: display the vlans and the interfaces
+      hwos_command:
+        sport: "{{ sport }}"
+        shost: "{{ shost }}"
+        suser: "{{ suser }}"
+        spass: "{{ spass }}"
+        commands:
+          - display vlan
+          - display interface brief
+
+    - name: collect the mac address table as data
+      hwos_command:
+        sport: "{{ sport }}"
+        shost: "{{ shost }}"
+        suser: "{{ suser }}"
+        spass: "{{ spass }}"
+        parse: yes
+        commands:
+          - display mac-address
+      register: macs
 """
 
 
-RETUN = """
+RETURN = """
 stdout:
-  description: the set of responses from the commands
+  description: the set of responses from the commands, a single string for I(command)
   returned: always
   type: list
   sample: ['...', '...']
@@ -92,19 +219,96 @@ stdout_lines:
   type: list
   sample: [['...', '...'], ['...'], ['...']]
 
+command_results:
+  description: command, rc, stdout, stderr and error of every command, aligned with stdout_lines
+  returned: when commands is given
+  type: list
+  sample: [{"command": "display vlan", "rc": 0, "stdout": "...", "stderr": ""}]
+
+parsed:
+  description: rows parsed from the output of each command, aligned with stdout, null for commands without a parser
+  returned: when parse is yes
+  type: list
+  sample: [[{"interface": "GigabitEthernet0/0/1", "phy": "up", "protocol": "up", "in_uti": "0.01%",
+             "out_uti": "0.01%", "in_errors": "0", "out_errors": "0"}], null]
+
+config_diff:
+  description: configuration lines added and removed by the commands
+  returned: when config_diff is yes
+  type: dict
+  sample: {"added": ["vlan batch 800", " port default vlan 800"], "removed": []}
+
+error:
+  description: the error pattern that matched the first rejected command and the output line it matched
+  returned: when a command was rejected
+  type: dict
+  sample: {"pattern": "Error:", "line": "Error: Unrecognized command found at '^' position."}
+
 command:
   description: rum command
   returned: always
   type: str
   sample: display version
+
+output:
+  description: path, size in bytes and sha1 of the file the output was streamed to
+  returned: when output_file is given
+  type: dict
+  sample: {"path": "/backup/192.168.77.140.cfg", "size": 482133, "sha1": "6c4e2b..."}
+
+truncated:
+  description: whether output_limit dropped the beginning of any output
+  returned: when output_limit is given
+  type: bool
+  sample: false
+
+timing:
+  description:
+    - seconds spent in tcp connect, ssh auth, shell open (login banner and pager set-up) and save,
+      bytes received, pager pages followed and duration, bytes and pages of every command.
+    - connect, auth and shell are null when a persistent session was reused.
+  returned: always
+  type: dict
+  sample: {"connect": 0.0021, "auth": 0.8413, "shell": 0.1032, "save": null, "bytes": 5120, "pages": 0,
+           "commands": [{"command": "display version", "duration": 0.0815, "bytes": 1860, "pages": 0}]}
+
+results:
+  description: per device host, rc, stdout, stderr, changed, failed, duration and msg on failure
+  returned: when hosts is given
+  type: list
+  sample: [{"host": "192.168.77.140", "rc": 0, "stdout": "...", "stderr": "", "changed": false,
+            "failed": false, "duration": 0.84}]
+
+session:
+  description: session broker counters, C(hit) and C(reconnect) describe this task
+  returned: when persistent is yes
+  type: dict
+  sample: {"hit": true, "reconnect": false, "hits": 41, "misses": 2, "reconnects": 0}
 """
 
 
-import time
+import difflib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
 import re
+import select
+import socket
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_bytes
+from ansible.module_utils._text import to_bytes, to_native
 from ansible.errors import AnsibleError, AnsibleConnectionFailure
 
 try:
@@ -138,152 +342,1089 @@ terminal_stderr_re = [
         re.compile(r"Error:", re.I)
     ]
 
+# 所有错误提示合成一个正则, 每块输出只扫描一次; python2 不支持局部标志, 统一忽略大小写
+terminal_error_re = re.compile('|'.join('(?P<error%d>%s)' % (i, regex.pattern)
+                                        for i, regex in enumerate(terminal_stderr_re)), re.I | re.M)
+
+pager_re = re.compile(r'-+ ?More ?-+\s*$')
+# 分页提示, 翻页后擦除提示的光标移动和其它 ANSI 控制序列
+terminal_noise_re = re.compile(r' *-{2,} ?More ?-{2,}|\x1b\[\d+D *\x1b\[\d+D|\x1b\[[0-9;?]*[A-Za-z]')
+confirm_re = re.compile(r'\[Y/N\]:?\s*$', re.I)
+save_success_re = re.compile(r'successfully', re.I)
+
+# 每次从通道读取的字节数
+BUFFER_SIZE = 65536
+# 匹配提示符时只看缓冲区末尾的这么多字符
+PROMPT_TAIL = 256
+# 依次尝试关闭分页, 都不支持时由读取循环翻页
+PAGER_COMMANDS = ('screen-length 0 temporary', 'screen-length disable')
+# save 写 flash 可能比普通命令慢
+SAVE_TIMEOUT = 60
+
+# 会话代理的 socket 目录, 只有当前用户可以访问
+BROKER_DIR = os.path.expanduser(os.environ.get('ANSIBLE_HWOS_DIR', '~/.ansible/hwos'))
+BROKER_SOCKET = os.path.join(BROKER_DIR, 'broker.sock')
+# 没有会话后代理进程再等多久退出
+BROKER_IDLE = 60
+BROKER_START_TIMEOUT = 10
+# 配置快照, 按设备保存, 下次运行可以作为基线
+SNAPSHOT_DIR = os.path.join(BROKER_DIR, 'snapshots')
+SNAPSHOT_COMMAND = 'display current-configuration'
+# 每次修改或保存都会变化的注释行, 不参与比较
+snapshot_ignore_re = re.compile(r'^!(Last configuration|Time:)')
+
+# display 命令的表格解析
+interface_brief_re = re.compile(r'^Interface\s+PHY\s+Protocol')
+ip_interface_brief_re = re.compile(r'^Interface\s+IP Address/Mask\s+Physical')
+lldp_brief_re = re.compile(r'^Local (?:Intf|Interface)')
+vlan_ports_header_re = re.compile(r'^VID\s+Type\s+Ports')
+vlan_status_header_re = re.compile(r'^VID\s+Status\s+Property')
+vlan_row_re = re.compile(r'^(\d+)\s+(\S+)\s*(.*)$')
+vlan_port_re = re.compile(r'(?:(UT|TG|MP|ST):)?([^\s(]+)\((\w)\)')
+mac_row_re = re.compile(r'^([0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4})\s+(\S+)\s*(.*)$')
+interface_name_re = re.compile(r'^\d*[A-Za-z][A-Za-z-]*\d+(?:/\d+)*(?:[.:]\d+)?$')
+MAC_TYPES = ('dynamic', 'static', 'blackhole', 'sticky', 'security', 'sec-config', 'authen', 'mux', 'snooping')
+INTERFACE_BRIEF_COLUMNS = [('Interface', 'interface'), ('PHY', 'phy'), ('Protocol', 'protocol'),
+                           ('InUti', 'in_uti'), ('OutUti', 'out_uti'), ('inErrors', 'in_errors'),
+                           ('outErrors', 'out_errors')]
+IP_INTERFACE_BRIEF_COLUMNS = [('Interface', 'interface'), ('IP Address/Mask', 'ip_address'),
+                              ('Physical', 'physical'), ('Protocol', 'protocol'), ('VPN', 'vpn')]
+LLDP_BRIEF_COLUMNS = [('Local Interface', 'local_interface'), ('Local Intf', 'local_interface'),
+                      ('Neighbor Interface', 'neighbor_interface'), ('Neighbor Intf', 'neighbor_interface'),
+                      ('Neighbor Device', 'neighbor_device'), ('Neighbor Dev', 'neighbor_device'),
+                      ('Exptime(s)', 'exptime')]
+
+# 代理只转发这些 Hwcon 方法
+BROKER_METHODS = ('run', 'run_commands', 'save_config')
+
+
+class StreamCleaner(object):
+    '''
+    strips pager prompts and ANSI sequences from the output as it arrives; the last,
+    incomplete line is held back so that a sequence split across chunks is still removed.
+    '''
+
+    def __init__(self):
+        self.carry = ''
+
+    def feed(self, data):
+        data = self.carry + data
+        cut = data.rfind('\n') + 1
+        self.carry = data[cut:]
+        return terminal_noise_re.sub('', data[:cut])
+
+    def flush(self):
+        data, self.carry = self.carry, ''
+        return terminal_noise_re.sub('', data)
+
+
+def strip_newline(data):
+    if data.endswith('\r\n'):
+        return data[:-2]
+    if data.endswith('\n'):
+        return data[:-1]
+    return data
+
+
+class OutputSink(object):
+    '''
+    receives the cleaned output of one command, line by line as it is read; the echoed
+    command line is skipped and the prompt line never arrives, the reader returns it instead.
+    once an error pattern matched the rest of the output is read but not kept.
+    '''
+
+    def __init__(self):
+        self.echo = True
+        self.error = None
+        self.truncated = False
+        self.chunks = []
+
+    def write(self, data):
+        if self.echo:
+            cut = data.find('\n') + 1
+            if not cut:
+                return
+            self.echo = False
+            data = data[cut:]
+        if not data or self.error:
+            return
+        match = terminal_error_re.search(data)
+        if match:
+            start = data.rfind('\n', 0, match.start()) + 1
+            end = data.find('\n', match.end())
+            if end < 0:
+                end = len(data)
+            self.error = {'pattern': terminal_stderr_re[int(match.lastgroup[5:])].pattern,
+                          'line': data[start:end].strip()}
+        self.store(data)
+
+    def store(self, data):
+        self.chunks.append(data)
+
+    def value(self):
+        return strip_newline(''.join(self.chunks))
+
+
+class RingSink(OutputSink):
+    ''' keeps only the last limit characters of the output '''
+
+    def __init__(self, limit):
+        OutputSink.__init__(self)
+        self.limit = limit
+        self.chunks = deque()
+        self.size = 0
+
+    def store(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+            self.truncated = True
+
+    def value(self):
+        data = strip_newline(''.join(self.chunks))
+        if len(data) > self.limit:
+            data = data[-self.limit:]
+            self.truncated = True
+        return data
+
+
+class FileSink(OutputSink):
+    ''' writes the output to an open file, nothing is kept in memory '''
+
+    def __init__(self, fileobj, digest):
+        OutputSink.__init__(self)
+        self.fileobj = fileobj
+        self.digest = digest
+        self.size = 0
+
+    def store(self, data):
+        b_data = to_bytes(data, errors='surrogate_or_strict')
+        self.fileobj.write(b_data)
+        self.digest.update(b_data)
+        self.size += len(b_data)
+
+    def value(self):
+        return ''
+
+
+class ParseSink(OutputSink):
+    ''' feeds the output line by line to a parser, the raw text is not kept '''
+
+    def __init__(self, parser):
+        OutputSink.__init__(self)
+        self.parser = parser
+
+    def store(self, data):
+        for line in data.splitlines():
+            self.parser.feed(line)
+
+    def value(self):
+        return ''
+
+
+class TableParser(object):
+    '''
+    turns the rows under a table header into dicts. the columns are located in the header
+    line; a row is split on whitespace when it has one word per column, by the header
+    positions otherwise.
+    '''
+
+    def __init__(self, header_re, titles):
+        self.header_re = header_re
+        self.titles = titles
+        self.columns = None
+        self.rows = []
+
+    def locate(self, header):
+        found = []
+        for title, key in self.titles:
+            start = header.find(title)
+            if start < 0 or any(s <= start < e for s, e, k in found):
+                continue
+            found.append((start, start + len(title), key))
+        found.sort()
+        return [(start, found[i + 1][0] if i + 1 < len(found) else None, key)
+                for i, (start, end, key) in enumerate(found)]
+
+    def feed(self, line):
+        if self.columns is None:
+            if self.header_re.match(line):
+                self.columns = self.locate(line)
+            return
+        if not line.strip() or line.lstrip().startswith('---'):
+            return
+        words = line.split()
+        if len(words) == len(self.columns):
+            values = words
+        else:
+            values = [line[start:end].strip() for start, end, key in self.columns]
+        self.rows.append(dict(zip([key for start, end, key in self.columns], values)))
+
+
+class VlanParser(object):
+    ''' display vlan: the member ports table merged with the status table, one dict per vlan '''
+
+    def __init__(self):
+        self.section = None
+        self.vlans = {}
+        self.rows = []
+        self.mode = None
+
+    def vlan(self, vid):
+        if vid not in self.vlans:
+            self.vlans[vid] = {'vid': vid}
+            self.rows.append(self.vlans[vid])
+        return self.vlans[vid]
+
+    def ports(self, vlan, text):
+        for mode, port, state in vlan_port_re.findall(text):
+            self.mode = mode or self.mode
+            vlan['ports'].append({'port': port, 'mode': self.mode, 'state': state})
+
+    def feed(self, line):
+        if vlan_ports_header_re.match(line):
+            self.section = 'ports'
+            return
+        if vlan_status_header_re.match(line):
+            self.section = 'status'
+            return
+        if self.section is None or not line.strip() or line.startswith('---'):
+            return
+        if self.section == 'ports':
+            match = vlan_row_re.match(line)
+            if match:
+                vlan = self.vlan(int(match.group(1)))
+                vlan.update(type=match.group(2), ports=[])
+                self.mode = None
+                self.ports(vlan, match.group(3))
+            elif line[0].isspace() and self.rows and 'ports' in self.rows[-1]:
+                # 端口太多时折行
+                self.ports(self.rows[-1], line)
+        else:
+            words = line.split(None, 5)
+            if len(words) >= 5 and words[0].isdigit():
+                self.vlan(int(words[0])).update(status=words[1], property=words[2], mac_learning=words[3],
+                                                 statistics=words[4],
+                                                 description=words[5].strip() if len(words) > 5 else '')
+
+
+class MacParser(object):
+    ''' display mac-address: one dict per entry, whatever the columns of the software version '''
+
+    def __init__(self):
+        self.rows = []
+
+    def feed(self, line):
+        match = mac_row_re.match(line)
+        if not match:
+            return
+        row = {'mac': match.group(1).lower(), 'vlan': match.group(2), 'port': None, 'type': None}
+        for word in match.group(3).split():
+            if row['port'] is None and interface_name_re.match(word):
+                row['port'] = word
+            elif row['type'] is None and word.lower() in MAC_TYPES:
+                row['type'] = word.lower()
+        self.rows.append(row)
+
+
+# 命令支持简写, 如 dis int br
+PARSERS = (
+    (re.compile(r'^dis\w* int\w* br\w*$', re.I), TableParser, (interface_brief_re, INTERFACE_BRIEF_COLUMNS)),
+    (re.compile(r'^dis\w* ip int\w* br\w*$', re.I), TableParser,
+     (ip_interface_brief_re, IP_INTERFACE_BRIEF_COLUMNS)),
+    (re.compile(r'^dis\w* lldp nei\w* br\w*$', re.I), TableParser, (lldp_brief_re, LLDP_BRIEF_COLUMNS)),
+    (re.compile(r'^dis\w* vlan( \d+)?$', re.I), VlanParser, ()),
+    (re.compile(r'^dis\w* mac-a\w*( .*)?$', re.I), MacParser, ()),
+)
+
+
+def parser_for(command):
+    ''' a fresh parser for the output of command, None when there is no parser for it '''
+    command = ' '.join(command.split())
+    for regex, parser, args in PARSERS:
+        if regex.match(command):
+            return parser(*args)
+    return None
+
+
+def new_timing():
+    ''' seconds per phase, bytes received and pager pages followed '''
+    return {'connect': None, 'auth': None, 'shell': None, 'save': None, 'bytes': 0, 'pages': 0, 'commands': []}
+
+
+def merge_timing(timing, other):
+    for key in ('connect', 'auth', 'shell', 'save'):
+        if other[key] is not None:
+            timing[key] = other[key]
+    timing['bytes'] += other['bytes']
+    timing['pages'] += other['pages']
+    timing['commands'].extend(other['commands'])
+
 
 class Hwcon(object):
     shell = None
     client = None
+    paging = True
+    trace = None
 
-    def __init__(self, address, username, password, port=22):
+    def __init__(self, address, username, password, port=22, timeout=30, trace=None):
         display.vv("Connecting to network device on ip", str(address) + ".")
-        self.client = paramiko.client.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
-        self.client.connect(address, port=port, username=username, password=password, look_for_keys=False,
-                            allow_agent=False)
+        self.timeout = timeout
+        self.timing = new_timing()
+        try:
+            if trace:
+                self.open_trace(trace)
+            start = time.time()
+            sock = socket.create_connection((address, port), timeout)
+            self.timing['connect'] = round(time.time() - start, 4)
+            start = time.time()
+            self.client = paramiko.client.SSHClient()
+            self.client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+            self.client.connect(address, port=port, username=username, password=password, look_for_keys=False,
+                                allow_agent=False, timeout=timeout, sock=sock)
+            self.timing['auth'] = round(time.time() - start, 4)
+        except Exception:
+            self.close()
+            raise
 
     def close(self):
         if self.client is not None:
             self.client.close()
+        self.close_trace()
+
+    def open_trace(self, path):
+        self.trace = open(path, 'a')
+
+    def close_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def log(self, direction, data):
+        ''' one timestamped line of the transcript '''
+        if self.trace is not None:
+            self.trace.write("%.6f %s %r\n" % (time.time(), direction, data))
+
+    def pop_timing(self):
+        timing, self.timing = self.timing, new_timing()
+        return timing
 
     def openShell(self):
+        start = time.time()
         self.shell = self.client.invoke_shell()
+        # 读掉登录信息, 直到出现第一个提示符
+        self.read_until()
+        # 关闭本次会话的分页
+        for command in PAGER_COMMANDS:
+            sink = OutputSink()
+            self.get_command_result(command, sink)
+            if not sink.error:
+                self.paging = False
+                break
+        self.timing['shell'] = round(time.time() - start, 4)
+
+    def alive(self):
+        transport = self.client.get_transport()
+        return (transport is not None and transport.is_active() and
+                not self.shell.closed and not self.shell.exit_status_ready())
+
+    def user_view(self):
+        ''' quit back to the user view '''
+        self.send_command()
+        stdout = self.read_until()
+        while not terminal_stdout_re[0].search(stdout):
+            self.send_command('quit')
+            stdout = self.read_until()
 
     def send_command(self, command=''):
-        if self.shell:
-            if command not in ('?',):
-                command += "\n"
-            self.shell.send(command)
+        if command not in ('?',):
+            command += "\n"
+        self.log('>', command)
+        self.shell.send(command)
 
+    def read_until(self, patterns=None, timeout=None, sink=None):
+        '''
+        read from the shell until one of the patterns matches the tail of the output.
+        with a sink the complete lines go to the sink and only the last line is returned.
+        '''
+        if patterns is None:
+            patterns = terminal_stdout_re
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        cleaner = StreamCleaner()
+        chunks = []
+        tail = ''
         while True:
-            if self.shell.recv_ready() or self.shell.recv_stderr_ready():
-                break
-            time.sleep(0.1)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AnsibleConnectionFailure("timeout waiting for the device prompt, last output: %r" % tail[-80:])
+            if not select.select([self.shell], [], [], remaining)[0]:
+                continue
+            data = self.shell.recv(BUFFER_SIZE)
+            if not data:
+                raise AnsibleConnectionFailure("connection closed by the device")
+            self.timing['bytes'] += len(data)
+            data = to_native(data, errors='surrogate_or_strict')
+            self.log('<', data)
+            if sink is None:
+                chunks.append(cleaner.feed(data))
+            else:
+                sink.write(cleaner.feed(data))
+            # 只在缓冲区末尾查找提示符
+            tail = (tail + data)[-PROMPT_TAIL:]
+            # 分页已关闭时不再查找分页提示, 输出中恰好以 More 结尾的行不会被误当作分页
+            if self.paging and pager_re.search(tail):
+                # 分页提示, 空格翻页
+                self.timing['pages'] += 1
+                self.log('>', ' ')
+                self.shell.send(' ')
+                tail = ''
+                continue
+            for regex in patterns:
+                if regex.search(tail):
+                    chunks.append(cleaner.flush())
+                    return ''.join(chunks)
 
-    def get_command_result(self, cmd):
-        buffersize = 4096
-        self.send_command()
-        self.shell.recv(buffersize)
+    def get_command_result(self, cmd, sink=None):
+        if sink is None:
+            sink = OutputSink()
+        start, received, pages = time.time(), self.timing['bytes'], self.timing['pages']
         self.send_command(cmd)
-        stdout = self.shell.recv(buffersize)
-        b_data = stdout.split('\r\n')
-        result_tmp = ''
-        while '- More -' in b_data[-1]:
-            self.shell.send("\n")
-            time.sleep(0.1)
-            tmp = self.shell.recv(buffersize)
-            b_data = tmp.split('\r\n')
-            result_tmp += tmp
-
+        self.read_until(sink=sink)
         if self.shell.recv_stderr_ready():
-            stderr = self.shell.recv_stderr(buffersize)
+            stderr = to_native(self.shell.recv_stderr(BUFFER_SIZE), errors='surrogate_or_strict')
         else:
             stderr = ''
-        stdout = '\r\n'.join(stdout.split('\r\n')[:-1]) + '\n' + result_tmp
-        stdout = stdout.replace('  ---- More ----', '').replace(
-            '\x1b[42D                                          \x1b[42D', '')
-        return stdout, stderr
-
-    def parse_result_data(self, data):
-        b_data = data.split('\r\n')
-        result = b_data[1:-1]
-        return '\r\n'.join(result)
+        self.timing['commands'].append({'command': cmd, 'duration': round(time.time() - start, 4),
+                                        'bytes': self.timing['bytes'] - received,
+                                        'pages': self.timing['pages'] - pages})
+        return sink.value(), stderr
 
     def save_config(self):
         rc = 1
-        buffersize = 4096
-        self.send_command()
-        stdout = self.shell.recv(buffersize)
-        t1 = terminal_stdout_re[0].findall(stdout)
-        while not t1:
-           self.send_command('quit')
-           stdout = self.shell.recv(buffersize)
-           t1 = terminal_stdout_re[0].findall(stdout)
+        start = time.time()
+        self.user_view()
         self.send_command('save')
-        time.sleep(0.1)
-        self.send_command('y')
-        time.sleep(3)
-        stdout = self.shell.recv(buffersize)
-        if stdout.find('successfully'):
+        stdout = self.read_until([confirm_re] + terminal_stdout_re)
+        if confirm_re.search(stdout):
+            self.send_command('y')
+            stdout = self.read_until(timeout=max(self.timeout, SAVE_TIMEOUT))
+        if save_success_re.search(stdout):
             rc = 0
+        self.timing['save'] = round(time.time() - start, 4)
         return rc
 
+    def run_commands(self, commands, stop_on_error=False, output_file=None, output_limit=None, parse=False):
+        '''
+        run each command to its prompt, return a result per command. the output goes
+        to output_file or is cut to its last output_limit characters when asked, with
+        parse the commands known to parser_for return rows instead of text.
+        '''
+        results = []
+        fileobj = None
+        if output_file:
+            fileobj = open(output_file, 'wb')
+            digest = hashlib.sha1()
+        try:
+            for command in commands:
+                parser = parser_for(command) if parse else None
+                if parser is not None:
+                    sink = ParseSink(parser)
+                elif fileobj is not None:
+                    sink = FileSink(fileobj, digest)
+                elif output_limit:
+                    sink = RingSink(output_limit)
+                else:
+                    sink = OutputSink()
+                stdout, stderr = self.get_command_result(command, sink)
+                result = {'command': command, 'rc': 1 if sink.error else 0, 'stdout': stdout, 'stderr': stderr}
+                if sink.error:
+                    result['error'] = sink.error
+                if parser is not None:
+                    result['parsed'] = parser.rows
+                elif fileobj is not None:
+                    # sha1 是到这条命令为止整个文件的校验和
+                    result['output'] = {'size': sink.size, 'sha1': digest.hexdigest()}
+                elif output_limit:
+                    result['truncated'] = sink.truncated
+                results.append(result)
+                if sink.error and stop_on_error:
+                    break
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+        return results
+
     def run(self, cmd):
-        rc = 1
-        stdout, stderr = self.get_command_result(cmd)
-        for regex in terminal_stderr_re:
-            r1 = regex.findall(stdout)
-        if not r1:
-           stdout = self.parse_result_data(stdout)
-           rc = 0
-        return rc, stdout, stderr
+        ''' run cmd line by line, stop at the first line the device rejects '''
+        lines = [line for line in cmd.splitlines() if line.strip()]
+        results = self.run_commands(lines, stop_on_error=True)
+        rc = max([r['rc'] for r in results] or [0])
+        stderr = results[-1]['stderr'] if results else ''
+        return rc, '\r\n'.join(r['stdout'] for r in results), stderr
 
 
-def main():
-    module = AnsibleModule(
-	    argument_spec = dict(
-	    command=dict(required=True, type='str'),
-	    shost=dict(required=True, type='str'),
-	    sport=dict(required=False, type='int', default=22),
-	    suser=dict(required=True, type='str'),
-	    spass=dict(required=True, type='str', no_log=True),
-	    save=dict(required=False, type='bool')
-	  )
-    )
+def recv_line(sock):
+    ''' read one newline terminated message from sock '''
+    chunks = []
+    while True:
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            break
+        chunks.append(data)
+        if data.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+
+class Session(object):
+    ''' one cached device shell of the session broker '''
+
+    def __init__(self, digest, ttl):
+        self.digest = digest
+        self.conn = None
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.ttl = ttl
 
-    b_command = to_bytes(module.params['command'], errors='surrogate_or_strict')
-    b_host = to_bytes(module.params['shost'], errors='surrogate_or_strict')
-    b_user = to_bytes(module.params['suser'], errors='surrogate_or_strict')
-    b_password = to_bytes(module.params['spass'], errors='surrogate_or_strict')
-    result = {'changed': False}
 
+class SessionBroker(object):
+    '''
+    Unix socket daemon keeping authenticated Hwcon shells open between module runs,
+    keyed by (shost, sport, suser) and closed after persistent_ttl idle seconds.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0}
+        self.last_active = time.time()
+
+    def serve(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(1)
+        try:
+            while True:
+                try:
+                    conn = server.accept()[0]
+                except socket.timeout:
+                    if self.expire():
+                        break
+                    continue
+                self.spawn(conn)
+            # 先删除 socket 让新的任务启动新代理, 再处理已经排队的连接
+            os.unlink(self.path)
+            server.settimeout(0.2)
+            while True:
+                try:
+                    conn = server.accept()[0]
+                except socket.timeout:
+                    break
+                self.handle(conn)
+        finally:
+            server.close()
+            for session in self.sessions.values():
+                if session.conn is not None:
+                    session.conn.close()
+
+    def spawn(self, conn):
+        worker = threading.Thread(target=self.handle, args=(conn,))
+        worker.daemon = True
+        worker.start()
+
+    def expire(self):
+        ''' close the idle sessions, tell whether the broker itself should exit '''
+        now = time.time()
+        with self.lock:
+            for key, session in list(self.sessions.items()):
+                if now - session.last_used < session.ttl or not session.lock.acquire(False):
+                    continue
+                try:
+                    del self.sessions[key]
+                    if session.conn is not None:
+                        session.conn.close()
+                finally:
+                    session.lock.release()
+            return not self.sessions and now - self.last_active > BROKER_IDLE
+
+    def handle(self, conn):
+        try:
+            try:
+                response = self.dispatch(json.loads(to_native(recv_line(conn), errors='surrogate_or_strict')))
+            except Exception as e:
+                response = {'error': str(e)}
+            conn.sendall(to_bytes(json.dumps(response), errors='surrogate_or_strict') + b'\n')
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def dispatch(self, request):
+        if request['method'] not in BROKER_METHODS:
+            raise ValueError("method %s is not allowed" % request['method'])
+        key = (request['host'], request['port'], request['user'])
+        digest = hashlib.sha256(to_bytes(request['password'], errors='surrogate_or_strict')).hexdigest()
+        with self.lock:
+            self.last_active = time.time()
+            session = stale = self.sessions.get(key)
+            if session is None or session.digest != digest:
+                session = self.sessions[key] = Session(digest, request['ttl'])
+        if stale is not None and stale is not session:
+            # 密码变了, 旧会话作废
+            with stale.lock:
+                if stale.conn is not None:
+                    stale.conn.close()
+                    stale.conn = None
+
+        with session.lock:
+            hit = reconnect = False
+            if session.conn is not None and session.conn.alive():
+                hit = True
+            elif session.conn is not None:
+                # 设备已断开, 比如空闲超时
+                reconnect = True
+                session.conn.close()
+                session.conn = None
+            try:
+                if session.conn is None:
+                    conn = Hwcon(request['host'], request['user'], request['password'], request['port'],
+                                 request['timeout'], request['trace'])
+                    try:
+                        conn.openShell()
+                    except Exception:
+                        # 还没有放进会话, 下面不会关闭它
+                        conn.close()
+                        raise
+                    session.conn = conn
+                else:
+                    if request['trace']:
+                        session.conn.open_trace(request['trace'])
+                    # 上一个任务可能停在系统视图
+                    session.conn.timeout = request['timeout']
+                    session.conn.user_view()
+                result = getattr(session.conn, request['method'])(*request['args'])
+                timing = session.conn.pop_timing()
+            except Exception:
+                if session.conn is not None:
+                    session.conn.close()
+                    session.conn = None
+                raise
+            finally:
+                if session.conn is not None:
+                    session.conn.close_trace()
+                session.ttl = request['ttl']
+                session.last_used = time.time()
+
+        with self.lock:
+            self.stats['hits' if hit else 'reconnects' if reconnect else 'misses'] += 1
+            stats = dict(self.stats, hit=hit, reconnect=reconnect)
+        return {'result': result, 'session': stats, 'timing': timing}
+
+
+def broker_alive(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-      connection = Hwcon(b_host, b_user, b_password, module.params['sport'])
-    except Exception as e:
-      raise AnsibleConnectionFailure(str(e))
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def start_broker(path=BROKER_SOCKET):
+    ''' start the session broker daemon unless one is already listening on path '''
+    if not os.path.isdir(BROKER_DIR):
+        os.makedirs(BROKER_DIR, 0o700)
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if broker_alive(path):
+            return
+        if os.path.exists(path):
+            os.unlink(path)
+        pid = os.fork()
+        if pid == 0:
+            # 两次 fork 脱离 ansible 的进程, 标准输入输出指向 /dev/null 以免 ansible 等待管道关闭
+            try:
+                lock.close()
+                os.setsid()
+                if os.fork() == 0:
+                    os.chdir('/')
+                    devnull = os.open(os.devnull, os.O_RDWR)
+                    for fd in (0, 1, 2):
+                        os.dup2(devnull, fd)
+                    os.close(devnull)
+                    SessionBroker(path).serve()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        deadline = time.time() + BROKER_START_TIMEOUT
+        while not broker_alive(path):
+            if time.time() > deadline:
+                raise AnsibleConnectionFailure("session broker did not start on %s" % path)
+            time.sleep(0.05)
+    finally:
+        lock.close()
+
+
+class BrokerClient(object):
+    ''' stands in for Hwcon and forwards the calls to the session broker '''
+
+    def __init__(self, address, username, password, port=22, timeout=30, ttl=300, trace=None):
+        self.request = dict(host=address, port=port, user=username, password=password, timeout=timeout, ttl=ttl,
+                            trace=trace)
+        self.session = {}
+        self.timing = new_timing()
+
+    def __getattr__(self, name):
+        if name not in BROKER_METHODS:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, args)
+
+    def call(self, method, args):
+        request = dict(self.request, method=method, args=args)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(BROKER_SOCKET)
+            except socket.error:
+                # 代理空闲退出了, 重新启动
+                start_broker()
+                sock.connect(BROKER_SOCKET)
+            sock.sendall(to_bytes(json.dumps(request), errors='surrogate_or_strict') + b'\n')
+            data = recv_line(sock)
+        finally:
+            sock.close()
+        if not data:
+            raise AnsibleConnectionFailure("session broker closed the connection")
+        response = json.loads(to_native(data, errors='surrogate_or_strict'))
+        if 'error' in response:
+            raise AnsibleConnectionFailure(response['error'])
+        self.session = response['session']
+        merge_timing(self.timing, response['timing'])
+        return response['result']
+
+    def openShell(self):
+        # 代理在第一次调用时登录
+        pass
+
+    def close(self):
+        # 会话留在代理中给后面的任务使用
+        pass
+
+
+def snapshot_path(host, port):
+    return os.path.join(SNAPSHOT_DIR, '%s_%s.cfg.gz' % (re.sub(r'[^\w.-]', '_', host), port))
+
+
+def load_snapshot(host, port):
+    ''' the cached configuration of the device, None when there is none '''
+    try:
+        f = gzip.open(snapshot_path(host, port), 'rb')
+    except IOError:
+        return None
+    try:
+        return to_native(f.read(), errors='surrogate_or_strict')
+    finally:
+        f.close()
+
+
+def store_snapshot(host, port, config):
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0o700)
+    fd, tmp = tempfile.mkstemp(dir=SNAPSHOT_DIR)
+    try:
+        raw = os.fdopen(fd, 'wb')
+        try:
+            f = gzip.GzipFile(fileobj=raw, mode='wb')
+            f.write(to_bytes(config, errors='surrogate_or_strict'))
+            f.close()
+        finally:
+            raw.close()
+        os.rename(tmp, snapshot_path(host, port))
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def fetch_config(connection):
+    result = connection.run_commands([SNAPSHOT_COMMAND])[0]
+    if result['rc'] != 0:
+        raise AnsibleError("cannot read the configuration: %s" % result['error']['line'])
+    return '\n'.join(result['stdout'].splitlines())
+
+
+def config_diff(before, after):
+    ''' added and removed configuration lines plus the unified diff of the two snapshots '''
+    before = [line for line in before.splitlines() if not snapshot_ignore_re.match(line)]
+    after = [line for line in after.splitlines() if not snapshot_ignore_re.match(line)]
+    added = []
+    removed = []
+    unified = []
+    for line in difflib.unified_diff(before, after, 'before', 'after', n=3, lineterm=''):
+        unified.append(line)
+        if line.startswith('+') and not line.startswith('+++'):
+            added.append(line[1:])
+        elif line.startswith('-') and not line.startswith('---'):
+            removed.append(line[1:])
+    return {'added': added, 'removed': removed}, '\n'.join(unified)
+
+
+def run_device(params, device, slot):
+    ''' run the command on one device, report failures in the result instead of raising '''
+    command = to_native(params['command'] or '', errors='surrogate_or_strict')
+    host = to_native(device['shost'], errors='surrogate_or_strict')
+    user = to_native(device['suser'], errors='surrogate_or_strict')
+    password = to_native(device['spass'], errors='surrogate_or_strict')
+    result = {'host': host, 'changed': False, 'failed': False, 'rc': 1, 'stdout': '', 'stderr': ''}
+    start = time.time()
+    trace = params['trace']
+    if trace:
+        # 代理进程的工作目录是 /, 需要绝对路径
+        trace = os.path.abspath(trace.replace('{host}', host))
+
     try:
-      connection.openShell()
+        if trace:
+            open(trace, 'w').close()
+        if params['persistent']:
+            connection = BrokerClient(host, user, password, device['sport'], params['timeout'],
+                                      params['persistent_ttl'], trace)
+        else:
+            connection = Hwcon(host, user, password, device['sport'], params['timeout'], trace)
     except Exception as e:
-      msg = "Failed to open session"
-      if len(str(e)) > 0:
-        msg += ": %s" % str(e)
-      raise AnsibleConnectionFailure(msg)
-    display.vvv("EXEC %s" % b_command, host=b_host)
+        result.update(failed=True, msg=str(e), duration=round(time.time() - start, 3))
+        return result
+    # 让调度线程可以在超时后关闭连接
+    slot['conn'] = connection
+
     try:
-      rc,stdout,stderr = connection.run(b_command)
+        try:
+            connection.openShell()
+        except Exception as e:
+            msg = "Failed to open session"
+            if len(str(e)) > 0:
+                msg += ": %s" % str(e)
+            raise AnsibleConnectionFailure(msg)
+        if params['commands']:
+            commands, stop_on_error = params['commands'], params['stop_on_error']
+        else:
+            commands, stop_on_error = [line for line in command.splitlines() if line.strip()], True
+        display.vvv("EXEC %s" % ', '.join(commands), host=host)
+        if params['config_diff']:
+            # 基线: 上次保存的快照或设备当前的配置
+            before = None
+            if params['config_baseline'] == 'cache':
+                before = load_snapshot(host, device['sport'])
+            if before is None:
+                before = fetch_config(connection)
+        output_file = params['output_file']
+        if output_file:
+            output_file = os.path.abspath(output_file.replace('{host}', host))
+        try:
+            results = connection.run_commands(commands, stop_on_error, output_file, params['output_limit'],
+                                              params['parse'])
+        except Exception as e:
+            raise AnsibleError('Exec command error.\n' + str(e))
+
+        errors = [r for r in results if r['rc'] != 0]
+        if output_file:
+            outputs = [r.pop('output') for r in results if 'output' in r]
+            result['output'] = {'path': output_file, 'size': sum(o['size'] for o in outputs),
+                                'sha1': outputs[-1]['sha1'] if outputs else None}
+        if params['output_limit']:
+            result['truncated'] = any(r.pop('truncated', False) for r in results)
+        if params['parse']:
+            result['parsed'] = [r.pop('parsed', None) for r in results]
+        if params['commands']:
+            result.update(rc=1 if errors else 0, stdout=[r['stdout'] for r in results],
+                          stdout_lines=[r['stdout'].splitlines() for r in results],
+                          stderr=''.join(r['stderr'] for r in results), command_results=results)
+            result['changed'] = any(r['rc'] == 0 and not r['command'].startswith('display') for r in results)
+            if errors:
+                result.update(failed=True, msg="%s: %s" % (errors[0]['command'], errors[0]['error']['line']),
+                              error=errors[0]['error'])
+        else:
+            rc = 1 if errors else 0
+            stdout = '\r\n'.join(r['stdout'] for r in results)
+            stderr = results[-1]['stderr'] if results else ''
+            result.update(rc=rc, stdout=stdout, stderr=stderr)
+
+            if rc == 0 and not command.startswith('display'):
+                result['changed'] = True
+            elif rc == 1:
+                result.update(failed=True, msg=stdout + stderr, error=errors[0]['error'])
+
+        if params['config_diff']:
+            # 命令失败时也比较, 前面的命令可能已经生效
+            after = fetch_config(connection)
+            store_snapshot(host, device['sport'], after)
+            diff, unified = config_diff(before, after)
+            result.update(changed=bool(diff['added'] or diff['removed']), config_diff=diff,
+                          diff={'prepared': unified})
+
+        if params['save'] and not result['failed'] and (result['changed'] or not params['config_diff']):
+            try:
+                save_rc = connection.save_config()
+            except Exception as e:
+                raise AnsibleError('Save config error.\n' + str(e))
+            if save_rc != 0:
+                result.update(failed=True, msg="not save config!")
+        if params['persistent']:
+            result['session'] = connection.session
     except Exception as e:
-       raise AnsibleError('Exec command error.\n' + str(e) )
+        result.update(failed=True, msg=str(e))
+    finally:
+        connection.close()
+    result['timing'] = connection.timing
+    result['duration'] = round(time.time() - start, 3)
+    return result
 
-    if rc == 0 and b_command.find('display'):
-        result['changed'] = True
-    elif rc == 1:
-	module.fail_json(msg=stdout+stderr)
 
-    if module.params['save']:
+def run_devices(params, devices):
+    ''' run the command on all devices with at most forks threads, each device bounded by device_timeout '''
+    jobs = queue.Queue()
+    for index, device in enumerate(devices):
+        jobs.put((index, device))
+    results = [None] * len(devices)
+    running = {}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                index, device = jobs.get_nowait()
+            except queue.Empty:
+                return
+            slot = {'start': time.time()}
+            with cond:
+                running[index] = slot
+            try:
+                result = run_device(params, device, slot)
+            except Exception as e:
+                # 线程退出后队列里的设备就没有结果了, 主线程会一直等待
+                result = {'host': device['shost'], 'changed': False, 'failed': True, 'rc': 1, 'stdout': '',
+                          'stderr': '', 'duration': round(time.time() - slot['start'], 3), 'msg': str(e)}
+            with cond:
+                running.pop(index, None)
+                # 已经按超时处理过的设备不再覆盖结果
+                if results[index] is None:
+                    results[index] = result
+                cond.notify()
+
+    for i in range(min(params['forks'], len(devices))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    device_timeout = params['device_timeout']
+    with cond:
+        while None in results:
+            now = time.time()
+            for index, slot in list(running.items()):
+                if now - slot['start'] < device_timeout:
+                    continue
+                del running[index]
+                results[index] = {'host': devices[index]['shost'], 'changed': False, 'failed': True, 'rc': 1,
+                                  'stdout': '', 'stderr': '', 'duration': round(now - slot['start'], 3),
+                                  'msg': "timed out after %d seconds" % device_timeout}
+                # 关闭连接, 让阻塞在读取上的线程尽快去处理下一台设备
+                if 'conn' in slot:
+                    try:
+                        slot['conn'].close()
+                    except Exception:
+                        pass
+            if None not in results:
+                break
+            starts = [slot['start'] for slot in running.values()]
+            cond.wait(max(min(starts) + device_timeout - now, 0.05) if starts else 1)
+    return results
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            command=dict(required=False, type='str'),
+            commands=dict(required=False, type='list'),
+            stop_on_error=dict(required=False, type='bool', default=False),
+            shost=dict(required=False, type='str'),
+            sport=dict(required=False, type='int', default=22),
+            suser=dict(required=False, type='str'),
+            spass=dict(required=False, type='str', no_log=True),
+            hosts=dict(required=False, type='list'),
+            forks=dict(required=False, type='int', default=10),
+            device_timeout=dict(required=False, type='int', default=300),
+            save=dict(required=False, type='bool'),
+            timeout=dict(required=False, type='int', default=30),
+            persistent=dict(required=False, type='bool', default=False),
+            persistent_ttl=dict(required=False, type='int', default=300),
+            output_file=dict(required=False, type='path'),
+            output_limit=dict(required=False, type='int'),
+            parse=dict(required=False, type='bool', default=False),
+            trace=dict(required=False, type='path'),
+            config_diff=dict(required=False, type='bool', default=False),
+            config_baseline=dict(required=False, type='str', default='device', choices=['device', 'cache'])
+        ),
+        required_one_of=[['shost', 'hosts'], ['command', 'commands']],
+        mutually_exclusive=[['shost', 'hosts'], ['command', 'commands'], ['output_file', 'output_limit']]
+    )
+    params = module.params
+    # 设备自己的密码也不能出现在返回结果和日志中
+    for item in params['hosts'] or []:
+        if isinstance(item, dict) and item.get('spass'):
+            module.no_log_values.add(item['spass'])
+
+    if params['output_file'] and params['hosts'] and len(params['hosts']) > 1 and \
+            '{host}' not in params['output_file']:
+        module.fail_json(msg="output_file needs a {host} placeholder when several hosts are given")
+    if params['trace'] and params['hosts'] and len(params['hosts']) > 1 and '{host}' not in params['trace']:
+        module.fail_json(msg="trace needs a {host} placeholder when several hosts are given")
+    if params['output_limit'] is not None and params['output_limit'] < 1:
+        module.fail_json(msg="output_limit must be a positive number")
+
+    # 获取设备列表, 设备没有指定的端口和账号使用模块参数
+    devices = []
+    for item in params['hosts'] or [{'shost': params['shost']}]:
+        if not isinstance(item, dict):
+            item = {'shost': item}
+        device = dict((key, item.get(key) or params[key]) for key in ('shost', 'sport', 'suser', 'spass'))
+        for key in ('shost', 'suser', 'spass'):
+            if not device[key]:
+                module.fail_json(msg="%s is required for device %s" % (key, device['shost']))
+        devices.append(device)
+
+    if params['persistent']:
+        # 在启动线程之前 fork 代理进程
         try:
-            save_rc = connection.save_config()
+            start_broker()
         except Exception as e:
-          raise AnsibleError('Save config error.\n' + str(e) )
-        if save_rc != 0:
-            msg= "not save config!"
-            module.fail_json(msg=msg)
-
-    connection.close()
+            raise AnsibleConnectionFailure(str(e))
 
-    result.update({
-	'command': b_command,
-        'rc': rc,
-        'stdout': stdout,
-        'stderr': stderr})
+    if params['hosts'] is None:
+        result = run_device(params, devices[0], {})
+        result['command'] = params['command'] or params['commands']
+        if result.pop('failed'):
+            module.fail_json(**result)
+        module.exit_json(**result)
 
+    results = run_devices(params, devices)
+    failed = [r['host'] for r in results if r['failed']]
+    result = {
+        'changed': any(r['changed'] for r in results),
+        'command': params['command'] or params['commands'],
+        'results': results}
+    if failed:
+        module.fail_json(msg="%d of %d devices failed: %s" % (len(failed), len(results), ', '.join(failed)),
+                         **result)
     module.exit_json(**result)
 
 if __name__ == '__main__':
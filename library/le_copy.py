@@ -17,10 +17,15 @@ options:
   src:
     description:
       - Path to a file on the source file to remote host
+      - When src is a local directory it is copied recursively. If src ends with "/" only
+        its contents are copied into dest, otherwise the directory itself is created in dest.
+        Only missing and changed files are sent, as one archive. Symlinks are followed.
     required: true
   dest:
     description:
       - Path to the destination on the remote host for the copy
+      - A list of paths installs the same file into every one of them. The file is
+        uploaded once and each destination is compared and replaced on its own.
     required: true
   force:
     description:
@@ -37,7 +42,85 @@ options:
     choices: [ "True", "False" ]
     required: false
     default: "False"
+  delta:
+    description:
+      - If C(yes) and the destination already exists, only the blocks that differ from the
+        destination are sent, rsync style. The remote file is rebuilt from the old file plus
+        the delta and verified against the source checksum before it is moved into place.
+      - Falls back to a full copy when the delta would not be smaller than the source, when
+        more than 8MB of the source differ, or when nothing in its first 2MB matches.
+    choices: [ "yes", "no" ]
+    required: false
+    default: "no"
+  compress:
+    description:
+      - Compress the file on the controller and decompress it on the remote host while it
+        is written, for slow links. C(auto) uses gzip unless the file is small or already
+        compressed (by extension, magic bytes or a trial compression of its first 64KB).
+      - Directories are sent as a gzipped tar with any value other than C(no).
+    choices: [ "no", "auto", "gzip", "zlib" ]
+    required: false
+    default: "no"
+  compress_level:
+    description:
+      - zlib compression level used with C(compress), 1 is fastest and 9 is smallest.
+    required: false
+    default: 6
+  remote_cache:
+    description:
+      - Directory on the remote host used as a content addressed cache of copied files,
+        keyed by sha1. When the source is already in the cache nothing is uploaded and dest
+        is copied from the cache entry. New uploads are copied into the cache. Cache entries are verified against their sha1 before use.
+      - Disabled unless set, for example C(~/.ansible/le_copy_cache).
+    required: false
+  remote_cache_size:
+    description:
+      - Size cap of C(remote_cache) in bytes. The least recently used entries are removed by
+        the module once the cache grows past it.
+    required: false
+    default: 1073741824
+  chunk_size:
+    description:
+      - Upload files larger than this many bytes in chunks. Chunks are kept next to dest in
+        C(.<name>.<sha1>.part) until the whole file has arrived, so a retry after a dropped
+        connection only sends the chunks that are missing. Every chunk is checked on arrival
+        and the assembled file against the source sha1 before it is moved into place.
+      - C(0) disables chunked uploads.
+    required: false
+    default: 0
+  bwlimit:
+    description:
+      - Bandwidth budget in bytes per second (C(10M), C(500K), ...) shared by all le_copy
+        transfers running on the controller, whatever the fork, task or host.
+      - Every upload of file data books its size on the budget before it starts, module calls
+        are not throttled. Combine it with C(chunk_size) for smooth pacing of large files.
+    required: false
+  host_bwlimit:
+    description:
+      - Bandwidth budget in bytes per second for all le_copy transfers to the same remote host.
+    required: false
+  max_transfers:
+    description:
+      - Number of uploads of 8MB or more that may run at the same time on the controller,
+        further ones wait for a free slot.
+    required: false
+  block_size:
+    description:
+      - Block size in bytes used for C(delta). The default C(0) picks a size of roughly
+        the square root of the destination size, between 2KB and 128KB.
+    required: false
+    default: 0
 
+notes:
+    - When the destination already has the same sha1 as the source, nothing is uploaded
+      and the module is not run on the remote host.
+    - Checksums of source files are cached on the controller in
+      C(~/.ansible/le_copy/checksums.db), shared by all forks and runs and invalidated when
+      the inode, size or mtime of a file changes. Set C(ANSIBLE_LE_COPY_CACHE) to move it and
+      C(ANSIBLE_LE_COPY_CACHE_SIZE) (bytes, default 64MB) to change the size cap.
+    - Every run adds C(le_copy_skipped), C(le_copy_transferred) and C(le_copy_cached) to the custom stats,
+      summed over all hosts. Set C(show_custom_stats = True) in ansible.cfg to see them
+      in the play recap.
 author:
     - "Lework"
 '''
@@ -48,6 +131,45 @@ EXAMPLES = '''
   le_copy:
     src: /etc/herp/derp.conf
     dest: /root/herp-derp.conf
+
+# Only send the changed blocks of a large artifact
+- name: copy a release jar
+  le_copy:
+    src: app.jar
+    dest: /opt/app/app.jar
+    delta: yes
+
+# Install one certificate into several services
+- name: copy the site certificate
+  le_copy:
+    src: site.pem
+    dest:
+      - /etc/nginx/ssl/
+      - /etc/haproxy/ssl/
+      - /opt/app/conf/site.pem
+
+# Keep released artifacts on the host so rollbacks need no upload
+- name: deploy a release
+  le_copy:
+    src: "app-{{ version }}.jar"
+    dest: /opt/app/app.jar
+    remote_cache: ~/.ansible/le_copy_cache
+
+# Resume a large upload over a flaky link, retrying the task
+- name: copy a database seed
+  le_copy:
+    src: seed.dump
+    dest: /var/lib/db/seed.dump
+    chunk_size: 67108864
+  register: seed
+  until: seed is succeeded
+  retries: 5
+
+# Sync the contents of a local directory
+- name: copy the static site
+  le_copy:
+    src: site/
+    dest: /var/www/html
 '''
 
 RETURN = '''
@@ -101,39 +223,211 @@ state:
     returned: success
     type: string
     sample: "file"
+results:
+    description: per destination result when dest is a list
+    returned: when dest is a list
+    type: list
+    sample: [{"dest": "/etc/nginx/ssl/site.pem", "changed": true, "checksum": "6e642bb8dd5c2e027bf21dd923337cbb4214f827"}]
+files:
+    description: relative paths of the files and directories that were created or replaced
+                 when copying a directory
+    returned: when src is a directory
+    type: list
+    sample: ["css", "css/site.css", "index.html"]
+io:
+    description: bytes read and written on the remote host and the time the copy took
+    returned: when remote_src is used
+    type: dict
+    sample: {"read_bytes": 734003200, "written_bytes": 734003200, "elapsed": 3.52}
+cache_hit:
+    description: whether the file was installed from C(remote_cache) without an upload
+    returned: when remote_cache is set
+    type: bool
+    sample: true
+transfer:
+    description: how the file was sent, bytes sent over the wire, the time spent sending them, how long
+                 of that was spent waiting for the bandwidth limits and the throughput in bytes/s
+    returned: when a file was transferred
+    type: dict
+    sample: {"mode": "full", "compression": "gzip", "bytes": 1049612, "size": 7340032, "elapsed": 1.21,
+             "wait": 0.2, "throughput": 1038191}
 '''
 
+import hashlib
 import os
+import re
 import shutil
+import stat
+import struct
+import tarfile
+import tempfile
+import time
+import zlib
 
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_bytes, to_native
 from ansible.module_utils.pycompat24 import get_exception
 
+# 增量传输的文件头，与action插件保持一致
+DELTA_MAGIC = b'LEDELTA1'
+BUFSIZE = 1024 * 1024
+
+
+def auto_block_size(size):
+    ''' roughly sqrt(size) like rsync, rounded to 1KB and kept between 2KB and 128KB '''
+    return max(2048, min(131072, int(size ** 0.5) & ~1023))
+
+
+def block_signatures(b_path, block_size):
+    ''' weak (adler32) and strong (truncated sha1) checksum of every block of a file '''
+    blocks = []
+    f = open(b_path, 'rb')
+    try:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block) & 0xffffffff, hashlib.sha1(block).hexdigest()[:16]])
+    finally:
+        f.close()
+    return blocks
+
+
+def copy_stream(fsrc, fdst, length, digest=None):
+    ''' copy up to length bytes from fsrc to fdst, feeding them to digest '''
+    while length > 0:
+        data = fsrc.read(min(BUFSIZE, length))
+        if not data:
+            break
+        if digest is not None:
+            digest.update(data)
+        fdst.write(data)
+        length -= len(data)
+
+
+def apply_patch(b_patch, b_base, b_out):
+    ''' rebuild a file from b_base and the delta in b_patch into b_out, returns its sha1 '''
+    digest = hashlib.sha1()
+    patch = open(b_patch, 'rb')
+    base = open(b_base, 'rb')
+    out = open(b_out, 'wb')
+    try:
+        header = patch.read(len(DELTA_MAGIC) + 4)
+        if header[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+            raise ValueError("not a le_copy delta")
+        block_size = struct.unpack('>I', header[len(DELTA_MAGIC):])[0]
+        while True:
+            op = patch.read(1)
+            if not op:
+                break
+            if op == b'C':
+                first, count = struct.unpack('>II', patch.read(8))
+                base.seek(first * block_size)
+                copy_stream(base, out, count * block_size, digest)
+            elif op == b'L':
+                length = struct.unpack('>I', patch.read(4))[0]
+                copy_stream(patch, out, length, digest)
+            else:
+                raise ValueError("corrupt le_copy delta")
+    finally:
+        patch.close()
+        base.close()
+        out.close()
+    return digest.hexdigest()
+
+
 def main():
     # 定义modules需要的参数
     module = AnsibleModule(
         argument_spec=dict(
-            src=dict(required=True, type='path'),
-            dest=dict(required=True, type='path'),
+            src=dict(required=False, type='path'),
+            dest=dict(required=True, type='raw'),
             force=dict(default=True, type='bool'),
             original_basename=dict(required=False),
-            remote_src=dict(required=False, type='bool')
+            remote_src=dict(required=False, type='bool'),
+            delta=dict(default=False, type='bool'),
+            block_size=dict(default=0, type='int'),
+            checksum=dict(required=False),
+            signatures=dict(default=False, type='bool'),
+            patch=dict(required=False, type='path'),
+            manifest=dict(required=False, type='dict'),
+            archive=dict(default=False, type='bool'),
+            compress=dict(default='no'),
+            compress_level=dict(default=6, type='int'),
+            compression=dict(required=False, choices=['zlib', 'gzip']),
+            probe=dict(default=False, type='bool'),
+            remote_cache=dict(required=False, type='path'),
+            remote_cache_size=dict(default=1073741824, type='int'),
+            from_cache=dict(default=False, type='bool'),
+            chunk_size=dict(default=0, type='int'),
+            chunks=dict(required=False, type='list'),
+            chunk_index=dict(required=False, type='int'),
+            assemble=dict(default=False, type='bool'),
+            bwlimit=dict(required=False),
+            host_bwlimit=dict(required=False),
+            max_transfers=dict(required=False, type='int'),
         ),
         supports_check_mode=True,
     )
 
     # 获取modules的参数
     src = module.params['src']
-    dest = module.params['dest']
+    dests = module.params['dest']
+    if not isinstance(dests, list):
+        dests = [dests]
+    dests = [os.path.expanduser(os.path.expandvars(to_native(d, errors='surrogate_or_strict'))) for d in dests]
+    dest = dests[0]
     b_src = to_bytes(src, errors='surrogate_or_strict')
     b_dest = to_bytes(dest, errors='surrogate_or_strict')
     force = module.params['force']
     remote_src = module.params['remote_src']
     original_basename = module.params.get('original_basename', None)
 
+    # 增量传输第一步：返回目标文件的块签名
+    if module.params['signatures']:
+        if not os.path.isfile(b_dest) or not os.access(b_dest, os.R_OK):
+            module.fail_json(msg="Destination %s is not a readable file" % (dest))
+        size = os.path.getsize(b_dest)
+        block_size = module.params['block_size'] or auto_block_size(size)
+        module.exit_json(changed=False, dest=dest, signatures=dict(
+            block_size=block_size, size=size, blocks=block_signatures(b_dest, block_size)))
+
+    # 增量传输第二步：用目标文件和增量数据重建文件
+    if module.params['patch']:
+        install_patch(module, module.params['patch'], dest)
+
+    # 目录同步第一步：返回与控制端清单不一致的文件
+    if module.params['manifest'] is not None:
+        if os.path.exists(b_dest) and not os.path.isdir(b_dest):
+            module.fail_json(msg="Destination %s is not a directory" % (dest))
+        stale = stale_entries(module, b_dest, module.params['manifest'], force)
+        module.exit_json(changed=False, dest=dest, stale=stale)
+
+    # 目录同步第二步：解压变化的文件到目标目录
+    if module.params['archive']:
+        unpack_archive(module, src, dest)
+
+    # 多目标路径第一步：返回需要更新的路径
+    if module.params['probe']:
+        stale = []
+        for path in dests:
+            b_path = to_bytes(path, errors='surrogate_or_strict')
+            if not os.path.isfile(b_path) or (force and module.sha1(path) != module.params['checksum']):
+                stale.append(path)
+        module.exit_json(changed=False, dest=dests, stale=stale)
+
+    # 分块上传：准备、接收单个分块、合并
+    if module.params['chunks'] is not None:
+        chunked_upload(module, src, dest)
+
+    # 从远程缓存安装
+    if module.params['from_cache']:
+        install_from_cache(module, dests)
+
     # 判断参数是否合规
+    if src is None:
+        module.fail_json(msg="src is required")
     if not os.path.exists(b_src):
         module.fail_json(msg="Source %s not found" % (src))
     if not os.access(b_src, os.R_OK):
@@ -141,23 +435,31 @@ def main():
     if os.path.isdir(b_src):
         module.fail_json(msg="Remote copy does not support recursive copy of directory: %s" % (src))
 
-    # 获取文件的sha1
-    checksum_src = module.sha1(src)
+    # 获取文件的sha1，上传的文件直接使用控制端算好的值
+    checksum_src = module.params['checksum']
+    if not checksum_src and not remote_src:
+        checksum_src = module.sha1(src)
     checksum_dest = None
 
     changed = False
 
+    # 多个目标路径
+    if isinstance(module.params['dest'], list):
+        install_many(module, src, dests, checksum_src)
+
     # 确定dest文件路径
     if original_basename and dest.endswith(os.sep):
         dest = os.path.join(dest, original_basename)
         b_dest = to_bytes(dest, errors='surrogate_or_strict')
+    # 远端拷贝到已存在的目录时拷贝到目录下的同名文件
+    if remote_src and os.path.isdir(b_dest):
+        dest = os.path.join(dest, os.path.basename(src))
+        b_dest = to_bytes(dest, errors='surrogate_or_strict')
 
     # 判断目标文件是否存在
     if os.path.exists(b_dest):
         if not force:
             module.exit_json(msg="file already exists", src=src, dest=dest, changed=False)
-        if os.access(b_dest, os.R_OK):
-            checksum_dest = module.sha1(dest)
     # 目录不存在，退出执行
     elif not os.path.exists(os.path.dirname(b_dest)):
         try:
@@ -168,21 +470,49 @@ def main():
                 module.fail_json(msg="Destination directory %s is not accessible" % (os.path.dirname(dest)))
         module.fail_json(msg="Destination directory %s does not exist" % (os.path.dirname(dest)))
 
+    # 远端拷贝时边拷贝边计算sha1，源文件只读一次
+    if remote_src:
+        try:
+            checksum_src, changed, io = copy_if_changed(module, b_src, b_dest)
+        except (IOError, OSError):
+            e = get_exception()
+            module.fail_json(msg="failed to copy: %s to %s: %s" % (src, dest, to_native(e)))
+        module.exit_json(dest=dest, src=src, checksum=checksum_src, changed=changed, io=io)
+
+    # 压缩传输的文件边解压边计算sha1，写到目标目录下的临时文件
+    compression = module.params['compression']
+    if compression:
+        try:
+            b_src, checksum_unpacked = decompress_file(b_src, b_dest, compression)
+        except (IOError, OSError, zlib.error):
+            e = get_exception()
+            module.fail_json(msg="failed to decompress %s: %s" % (src, to_native(e)))
+        if checksum_unpacked != checksum_src:
+            os.unlink(b_src)
+            module.fail_json(msg="checksum mismatch after decompressing %s" % (src), checksum=checksum_unpacked)
+
+    # 大小不同时文件肯定不同，不需要读取目标文件计算sha1
+    if os.path.isfile(b_dest) and os.access(b_dest, os.R_OK) and \
+            os.path.getsize(b_dest) == os.path.getsize(b_src):
+        checksum_dest = module.sha1(dest)
+
     # 源文件与目标文件sha1值不一致时覆盖源文件
     if checksum_src != checksum_dest:
       if not module.check_mode:
+        cache_store(module, b_src, checksum_src)
         try:
-            if remote_src:
-                shutil.copy(b_src, b_dest)
-            else:
-                module.atomic_move(b_src, b_dest)
+            module.atomic_move(b_src, b_dest)
         except IOError:
             module.fail_json(msg="failed to copy: %s to %s" % (src, dest))
         changed = True
 
     else:
         changed = False
-	
+
+    # 未移动的解压临时文件需要清理
+    if compression and os.path.exists(b_src):
+        os.unlink(b_src)
+
     # 返回值
     res_args = dict(
         dest=dest, src=src, checksum=checksum_src, changed=changed
@@ -191,5 +521,529 @@ def main():
     module.exit_json(**res_args)
 
 
+def install_patch(module, patch, dest):
+    ''' rebuild dest from its current content and an uploaded delta, then move it into place '''
+    b_dest = to_bytes(dest, errors='surrogate_or_strict')
+    if not module.params['checksum']:
+        module.fail_json(msg="checksum is required with patch")
+    if not os.path.isfile(b_dest):
+        module.fail_json(msg="Destination %s is not a file" % (dest))
+
+    fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=os.path.dirname(b_dest))
+    os.close(fd)
+    try:
+        checksum = apply_patch(to_bytes(patch, errors='surrogate_or_strict'), b_dest, b_tmp)
+    except (IOError, ValueError, struct.error):
+        os.unlink(b_tmp)
+        e = get_exception()
+        module.fail_json(msg="failed to apply delta to %s: %s" % (dest, to_native(e)))
+
+    if checksum != module.params['checksum']:
+        os.unlink(b_tmp)
+        module.fail_json(msg="checksum mismatch after applying delta to %s" % (dest),
+                         checksum=checksum, delta_mismatch=True)
+
+    if module.check_mode:
+        os.unlink(b_tmp)
+    else:
+        cache_store(module, b_tmp, checksum)
+        module.atomic_move(b_tmp, b_dest)
+    module.exit_json(dest=dest, src=patch, checksum=checksum, changed=True)
+
+
+def inflate(decompressor, chunk):
+    ''' yield the decompressed data of chunk in pieces of at most BUFSIZE bytes '''
+    data = decompressor.decompress(chunk, BUFSIZE)
+    while data:
+        yield data
+        data = decompressor.decompress(decompressor.unconsumed_tail, BUFSIZE)
+
+
+def decompress_file(b_src, b_dest, compression):
+    '''
+    Stream-decompress b_src into a temp file next to b_dest with bounded memory,
+    hashing the output as it is written. Returns (temp path, sha1).
+    '''
+    wbits = zlib.MAX_WBITS
+    if compression == 'gzip':
+        wbits += 16
+    decompressor = zlib.decompressobj(wbits)
+    digest = hashlib.sha1()
+
+    fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=os.path.dirname(b_dest))
+    out = os.fdopen(fd, 'wb')
+    f = open(b_src, 'rb')
+    try:
+        try:
+            while True:
+                chunk = f.read(BUFSIZE)
+                if not chunk:
+                    break
+                for data in inflate(decompressor, chunk):
+                    digest.update(data)
+                    out.write(data)
+            data = decompressor.flush()
+            digest.update(data)
+            out.write(data)
+        finally:
+            f.close()
+            out.close()
+    except Exception:
+        os.unlink(b_tmp)
+        raise
+    return b_tmp, digest.hexdigest()
+
+
+def kernel_copy(fsrc, fdst, length):
+    ''' copy the first length bytes of fsrc to fdst, in the kernel when the platform allows it '''
+    copied = 0
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while copied < length:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), length - copied, copied, copied)
+                if not n:
+                    break
+                copied += n
+        elif hasattr(os, 'sendfile'):
+            while copied < length:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, length - copied)
+                if not n:
+                    break
+                copied += n
+    except OSError:
+        pass
+    if copied < length:
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        copy_stream(fsrc, fdst, length - copied)
+    fsrc.seek(length)
+    fdst.seek(length)
+
+
+def copy_if_changed(module, b_src, b_dest):
+    '''
+    Copy b_src over b_dest with a single read of the source, hashing it on the way.
+    When both files have the same size they are compared block by block first and
+    writing only starts at the first difference, the equal prefix is then copied
+    in the kernel. The destination is never hashed. Returns (sha1, changed, io).
+    '''
+    start = time.time()
+    digest = hashlib.sha1()
+    io = dict(read_bytes=0, written_bytes=0)
+    size = os.path.getsize(b_src)
+    changed = True
+    offset = 0
+    pending = b''
+
+    fsrc = open(b_src, 'rb')
+    try:
+        # 大小一致时先逐块比较
+        if os.path.isfile(b_dest) and os.access(b_dest, os.R_OK) and os.path.getsize(b_dest) == size:
+            fdest = open(b_dest, 'rb')
+            try:
+                while True:
+                    data = fsrc.read(BUFSIZE)
+                    if not data:
+                        changed = False
+                        break
+                    old = fdest.read(len(data))
+                    io['read_bytes'] += len(data) + len(old)
+                    digest.update(data)
+                    if data != old:
+                        pending = data
+                        break
+                    offset += len(data)
+            finally:
+                fdest.close()
+
+        if changed and module.check_mode:
+            while True:
+                data = fsrc.read(BUFSIZE)
+                if not data:
+                    break
+                io['read_bytes'] += len(data)
+                digest.update(data)
+        elif changed:
+            fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=os.path.dirname(b_dest))
+            out = os.fdopen(fd, 'wb')
+            try:
+                try:
+                    kernel_copy(fsrc, out, offset)
+                    fsrc.seek(offset + len(pending))
+                    out.write(pending)
+                    io['written_bytes'] += offset + len(pending)
+                    while True:
+                        data = fsrc.read(BUFSIZE)
+                        if not data:
+                            break
+                        digest.update(data)
+                        out.write(data)
+                        io['read_bytes'] += len(data)
+                        io['written_bytes'] += len(data)
+                finally:
+                    out.close()
+                shutil.copymode(b_src, b_tmp)
+                module.atomic_move(b_tmp, b_dest)
+            finally:
+                # atomic_move 失败时用 fail_json 退出, 临时文件同样要清理
+                if os.path.exists(b_tmp):
+                    os.unlink(b_tmp)
+    finally:
+        fsrc.close()
+
+    io['elapsed'] = round(time.time() - start, 3)
+    return digest.hexdigest(), changed, io
+
+
+def install_many(module, src, dests, checksum_src):
+    ''' install src into every path of dests, each one is compared and replaced atomically on its own '''
+    b_src = to_bytes(src, errors='surrogate_or_strict')
+    original_basename = module.params['original_basename']
+    paths = []
+    for dest in dests:
+        if original_basename and dest.endswith(os.sep):
+            dest = os.path.join(dest, original_basename)
+        if not os.path.isdir(os.path.dirname(to_bytes(dest, errors='surrogate_or_strict'))):
+            module.fail_json(msg="Destination directory %s does not exist" % (os.path.dirname(dest)))
+        paths.append(dest)
+
+    b_unpacked = None
+    compression = module.params['compression']
+    if compression and not module.params['remote_src']:
+        try:
+            b_unpacked, checksum_unpacked = decompress_file(b_src, to_bytes(paths[0], errors='surrogate_or_strict'),
+                                                            compression)
+        except (IOError, OSError, zlib.error):
+            e = get_exception()
+            module.fail_json(msg="failed to decompress %s: %s" % (src, to_native(e)))
+        if checksum_unpacked != checksum_src:
+            os.unlink(b_unpacked)
+            module.fail_json(msg="checksum mismatch after decompressing %s" % (src), checksum=checksum_unpacked)
+        b_src = b_unpacked
+
+    if not module.check_mode and not module.params['remote_src']:
+        cache_store(module, b_src, checksum_src)
+
+    results = []
+    try:
+        for dest in paths:
+            b_dest = to_bytes(dest, errors='surrogate_or_strict')
+            if os.path.exists(b_dest) and not module.params['force']:
+                results.append(dict(dest=dest, changed=False, msg="file already exists"))
+                continue
+            try:
+                checksum, changed, io = copy_if_changed(module, b_src, b_dest)
+            except (IOError, OSError):
+                e = get_exception()
+                module.fail_json(msg="failed to copy: %s to %s: %s" % (src, dest, to_native(e)), results=results)
+            results.append(dict(dest=dest, changed=changed, checksum=checksum, io=io))
+    finally:
+        if b_unpacked is not None and os.path.exists(b_unpacked):
+            os.unlink(b_unpacked)
+
+    if checksum_src is None:
+        checksum_src = next((item['checksum'] for item in results if 'checksum' in item), None)
+    module.exit_json(dest=paths, src=src, checksum=checksum_src, results=results,
+                     changed=any(item['changed'] for item in results))
+
+
+def cache_entry(module, checksum, create=True):
+    ''' path of the remote cache entry for checksum, None when remote_cache is not used '''
+    if not module.params['remote_cache'] or not checksum:
+        return None
+    if not re.match(r'^[0-9a-f]{40}$', checksum):
+        module.fail_json(msg="invalid checksum for remote_cache: %s" % (checksum))
+    b_cache = to_bytes(module.params['remote_cache'], errors='surrogate_or_strict')
+    if create and not os.path.isdir(b_cache):
+        os.makedirs(b_cache, 0o700)
+    return os.path.join(b_cache, to_bytes(checksum))
+
+
+def cache_prune(module, b_keep):
+    ''' remove the least recently used entries until the cache fits in remote_cache_size '''
+    b_cache = os.path.dirname(b_keep)
+    entries = []
+    for b_name in os.listdir(b_cache):
+        if b_name.startswith(b'.'):
+            continue
+        b_path = os.path.join(b_cache, b_name)
+        try:
+            st = os.stat(b_path)
+        except OSError:
+            continue
+        entries.append((st.st_atime, st.st_size, b_path))
+    total = sum(entry[1] for entry in entries)
+    for atime, size, b_path in sorted(entries):
+        if total <= module.params['remote_cache_size']:
+            break
+        if b_path != b_keep:
+            os.unlink(b_path)
+            total -= size
+
+
+def cache_touch(b_entry):
+    ''' mark an entry as used, keeping its mtime '''
+    os.utime(b_entry, (time.time(), os.stat(b_entry).st_mtime))
+
+
+def cache_store(module, b_src, checksum):
+    '''
+    Add a copy of a verified file to the remote cache. Never a hardlink: atomic_move
+    changes owner and mode of the file it installs, which would change the cache entry
+    and every other dest sharing the inode.
+    '''
+    b_entry = cache_entry(module, checksum)
+    if b_entry is None:
+        return
+    try:
+        if not os.path.exists(b_entry):
+            fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=os.path.dirname(b_entry))
+            os.close(fd)
+            try:
+                shutil.copyfile(b_src, b_tmp)
+                os.rename(b_tmp, b_entry)
+            except (IOError, OSError):
+                os.unlink(b_tmp)
+                raise
+        cache_touch(b_entry)
+        cache_prune(module, b_entry)
+    except (IOError, OSError):
+        # 缓存只是优化，失败不影响拷贝
+        e = get_exception()
+        module.warn("could not add %s to remote_cache: %s" % (to_native(b_src), to_native(e)))
+
+
+def install_from_cache(module, dests):
+    '''
+    Install the cached copy of the checksum into dests. Exits with cache_hit=False
+    when the entry is missing, no longer matches its checksum or the cache cannot
+    be used, the action plugin then uploads the file. The cache is left alone in
+    check mode.
+    '''
+    checksum = module.params['checksum']
+    b_entry = cache_entry(module, checksum, create=False)
+    if b_entry is None:
+        module.fail_json(msg="remote_cache and checksum are required with from_cache")
+    try:
+        if not os.path.isfile(b_entry):
+            module.exit_json(changed=False, cache_hit=False)
+        if module.sha1(b_entry) != checksum:
+            if not module.check_mode:
+                os.unlink(b_entry)
+            module.exit_json(changed=False, cache_hit=False)
+    except (IOError, OSError):
+        e = get_exception()
+        module.warn("could not use remote_cache: %s" % to_native(e))
+        module.exit_json(changed=False, cache_hit=False)
+
+    results = []
+    for dest in dests:
+        b_dest = to_bytes(dest, errors='surrogate_or_strict')
+        if not os.path.isdir(os.path.dirname(b_dest)):
+            module.fail_json(msg="Destination directory %s does not exist" % (os.path.dirname(dest)), results=results)
+        if module.check_mode:
+            results.append(dict(dest=dest, changed=True, checksum=checksum))
+            continue
+        # 拷贝到目标旁的临时文件再移动, 每个目标有自己的 inode, 属主和权限互不影响
+        try:
+            checksum_dest, changed, io = copy_if_changed(module, b_entry, b_dest)
+        except (IOError, OSError):
+            e = get_exception()
+            # 缓存条目被并发的清理删除, 还没有安装任何目标时改为上传
+            if not results and not os.path.isfile(b_entry):
+                module.exit_json(changed=False, cache_hit=False)
+            module.fail_json(msg="failed to copy %s from remote_cache: %s" % (dest, to_native(e)), results=results)
+        results.append(dict(dest=dest, changed=changed, checksum=checksum_dest))
+
+    if not module.check_mode:
+        try:
+            cache_touch(b_entry)
+            cache_prune(module, b_entry)
+        except (IOError, OSError):
+            # 缓存只是优化，失败不影响拷贝
+            e = get_exception()
+            module.warn("could not update remote_cache: %s" % to_native(e))
+    res_args = dict(changed=any(item['changed'] for item in results), cache_hit=True, checksum=checksum)
+    if isinstance(module.params['dest'], list):
+        res_args.update(dest=[item['dest'] for item in results], results=results)
+    else:
+        res_args.update(dest=dests[0])
+    module.exit_json(**res_args)
+
+
+def part_dir(b_dest, checksum):
+    ''' directory next to b_dest holding the chunks of an upload until it is complete '''
+    b_dirname, b_name = os.path.split(b_dest)
+    return os.path.join(b_dirname, b'.' + b_name + b'.' + to_bytes(checksum) + b'.part')
+
+
+def chunked_upload(module, src, dest):
+    '''
+    The remote half of a resumable upload, driven by the action plugin:
+    without src and assemble it returns the chunks that are still missing,
+    with src it checks one uploaded chunk and keeps it, with assemble it
+    joins the chunks, verifies the result and moves it into place.
+    '''
+    b_dest = to_bytes(dest, errors='surrogate_or_strict')
+    checksum = module.params['checksum']
+    chunk_size = module.params['chunk_size']
+    sums = module.params['chunks']
+    if module.check_mode:
+        # 每一步都会在目标目录下写文件
+        module.fail_json(msg="chunked upload is not supported in check mode")
+    if not checksum or not re.match(r'^[0-9a-f]{40}$', checksum) or chunk_size <= 0:
+        module.fail_json(msg="checksum and chunk_size are required with chunks")
+    if not os.path.isdir(os.path.dirname(b_dest)):
+        module.fail_json(msg="Destination directory %s does not exist" % (os.path.dirname(dest)))
+    b_part = part_dir(b_dest, checksum)
+
+    def chunk_path(index):
+        return os.path.join(b_part, to_bytes('%06d' % index))
+
+    # 接收一个分块
+    if module.params['chunk_index'] is not None:
+        index = module.params['chunk_index']
+        b_src = to_bytes(src, errors='surrogate_or_strict')
+        if module.sha1(b_src) != sums[index]:
+            module.fail_json(msg="chunk %d of %s arrived corrupted" % (index, dest))
+        shutil.move(b_src, chunk_path(index))
+        module.exit_json(changed=False, dest=dest, chunk_index=index)
+
+    # 合并所有分块
+    if module.params['assemble']:
+        digest = hashlib.sha1()
+        fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=os.path.dirname(b_dest))
+        out = os.fdopen(fd, 'wb')
+        try:
+            for index in range(len(sums)):
+                f = open(chunk_path(index), 'rb')
+                try:
+                    copy_stream(f, out, chunk_size, digest)
+                finally:
+                    f.close()
+        except (IOError, OSError):
+            out.close()
+            os.unlink(b_tmp)
+            e = get_exception()
+            module.fail_json(msg="failed to assemble %s: %s" % (dest, to_native(e)))
+        out.close()
+        shutil.rmtree(b_part, ignore_errors=True)
+        if digest.hexdigest() != checksum:
+            os.unlink(b_tmp)
+            module.fail_json(msg="checksum mismatch after assembling %s" % (dest), checksum=digest.hexdigest())
+        cache_store(module, b_tmp, checksum)
+        module.atomic_move(b_tmp, b_dest)
+        module.exit_json(dest=dest, checksum=checksum, changed=True)
+
+    # 准备：清理同一目标的旧上传，返回缺失或损坏的分块
+    b_prefix = b'.' + os.path.basename(b_dest) + b'.'
+    for b_name in os.listdir(os.path.dirname(b_dest)):
+        b_path = os.path.join(os.path.dirname(b_dest), b_name)
+        if b_name.startswith(b_prefix) and b_name.endswith(b'.part') and b_path != b_part:
+            shutil.rmtree(b_path, ignore_errors=True)
+    if not os.path.isdir(b_part):
+        os.mkdir(b_part, 0o700)
+    missing = []
+    for index, chunk_sum in enumerate(sums):
+        b_chunk = chunk_path(index)
+        if os.path.isfile(b_chunk) and module.sha1(b_chunk) == chunk_sum:
+            continue
+        if os.path.exists(b_chunk):
+            os.unlink(b_chunk)
+        missing.append(index)
+    module.exit_json(changed=False, dest=dest, missing=missing)
+
+
+def stale_entries(module, b_dest, manifest, force):
+    '''
+    Relative paths of the controller manifest ({relpath: [size, mode, sha1]},
+    directories have no size and sha1) that are missing under b_dest or differ
+    from it. Files are only hashed when size and mode already agree.
+    '''
+    stale = []
+    for relpath in sorted(manifest):
+        size, mode, checksum = manifest[relpath]
+        b_path = os.path.join(b_dest, to_bytes(relpath, errors='surrogate_or_strict'))
+        try:
+            st = os.stat(b_path)
+        except OSError:
+            stale.append(relpath)
+            continue
+        if checksum is None:
+            if not stat.S_ISDIR(st.st_mode):
+                stale.append(relpath)
+        elif not stat.S_ISREG(st.st_mode):
+            stale.append(relpath)
+        elif force and (st.st_size != size or stat.S_IMODE(st.st_mode) != mode or
+                        module.sha1(b_path) != checksum):
+            stale.append(relpath)
+    return stale
+
+
+def unpack_archive(module, src, dest):
+    '''
+    Unpack a tar of new and changed files into dest. Every file is first written
+    to a temporary file next to its target and only renamed into place once the
+    whole archive has been unpacked, so a bad archive leaves dest untouched.
+    '''
+    b_dest = to_bytes(dest, errors='surrogate_or_strict')
+    if os.path.exists(b_dest) and not os.path.isdir(b_dest):
+        module.fail_json(msg="Destination %s is not a directory" % (dest))
+
+    files = []
+    dirs = []
+    staged = []
+    try:
+        tar = tarfile.open(src)
+        try:
+            for member in tar:
+                parts = member.name.split('/')
+                if os.path.isabs(member.name) or '..' in parts:
+                    raise tarfile.TarError("unsafe path in archive: %s" % member.name)
+                files.append(member.name)
+                if module.check_mode:
+                    continue
+                b_path = os.path.join(b_dest, to_bytes(member.name, errors='surrogate_or_strict'))
+                if member.isdir():
+                    if not os.path.isdir(b_path):
+                        os.makedirs(b_path)
+                    dirs.append((b_path, member.mode))
+                elif member.isfile():
+                    b_parent = os.path.dirname(b_path)
+                    if not os.path.isdir(b_parent):
+                        os.makedirs(b_parent)
+                    fd, b_tmp = tempfile.mkstemp(prefix=b'.le_copy', dir=b_parent)
+                    staged.append((b_tmp, b_path, member.mode))
+                    out = os.fdopen(fd, 'wb')
+                    try:
+                        shutil.copyfileobj(tar.extractfile(member), out, BUFSIZE)
+                    finally:
+                        out.close()
+                else:
+                    raise tarfile.TarError("unsupported member in archive: %s" % member.name)
+        finally:
+            tar.close()
+
+        for b_tmp, b_path, mode in staged:
+            os.chmod(b_tmp, mode)
+            if os.path.exists(b_path):
+                st = os.stat(b_path)
+                try:
+                    os.chown(b_tmp, st.st_uid, st.st_gid)
+                except OSError:
+                    pass
+            os.rename(b_tmp, b_path)
+        for b_path, mode in dirs:
+            os.chmod(b_path, mode)
+    except (IOError, OSError, tarfile.TarError):
+        e = get_exception()
+        for b_tmp, b_path, mode in staged:
+            if os.path.exists(b_tmp):
+                os.unlink(b_tmp)
+        module.fail_json(msg="failed to unpack %s into %s: %s" % (src, dest, to_native(e)))
+
+    module.exit_json(dest=dest, src=src, files=files, changed=bool(files))
+
+
 if __name__ == '__main__':
     main()
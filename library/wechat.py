@@ -46,7 +46,54 @@ options:
   msg:
     description:
       - The message body.
-    required: true
+      - One of I(msg) or I(messages) is required.
+  messages:
+    description:
+      - A list of messages sent in one run, each a string or a dict with C(msg) and optionally C(touser),
+        C(toparty) and C(totag). Messages without recipients go to the recipients of the module options.
+      - The access_token is fetched once and the messages are sent over keep-alive HTTPS connections.
+        Every message gets its own status in C(results); the task fails after the whole batch if any
+        message was not sent.
+  concurrency:
+    description:
+      - How many messages of I(messages) are sent at the same time, one connection each.
+    default: 4
+  retries:
+    description:
+      - How many times a message is sent again when Wechat answers system busy (-1) or
+        a frequency or concurrency limit (45009, 45033), waiting with exponential backoff and jitter.
+    default: 5
+  coalesce:
+    description:
+      - Merge the messages of I(messages) that go to the same recipients into one message, one line each,
+        as long as it stays within the 2048 bytes of a text message. Fewer messages count against
+        the per member limit.
+    type: bool
+    default: no
+  resolve:
+    description:
+      - Resolve member names in I(touser) and department names in I(toparty) to their ids and check
+        every recipient against the directory before sending. When a recipient is not found the
+        directory is fetched again once, so new members do not wait for I(directory_ttl). Messages
+        with unknown or ambiguous recipients are then not sent and reported instead.
+      - The departments and members visible to the application are cached on the host running the module
+        in C(directory.json) next to the token cache, the application needs read access to the directory.
+    type: bool
+    default: no
+  directory_ttl:
+    description:
+      - Seconds the cached directory is used before it is fetched again.
+    default: 3600
+notes:
+  - The access_token is cached in C(~/.ansible/wechat/tokens.json) (C(ANSIBLE_WECHAT_TOKEN_CACHE) overrides
+    the path) on the host running the module, shared by all forks and refreshed 5 minutes before it expires
+    or when Wechat reports it invalid.
+  - Sends are paced by token buckets shared by all forks through C(ratelimit.json) next to the token
+    cache, at most 10000 sends per minute per corpid and 30 messages per minute per member and
+    application, the documented Wechat limits.
+  - I(messages) keeps one verified HTTPS connection per thread, through the C(https_proxy) environment
+    variable when it is set. On Python versions without C(ssl.create_default_context) (before 2.7.9) or
+    with a proxy that is not C(http://), every message is sent with its own request like I(msg).
 author:
 - lework (@lework)
 '''
@@ -82,6 +129,29 @@ EXAMPLES = '''
     agentid: "100001"
     toparty: "10"
     msg: Ansible task finished
+
+# Send by member and department name.
+- wechat:
+    corpid: "123"
+    secret: "456"
+    agentid: "100001"
+    touser: "张三|李四"
+    toparty: "运维部"
+    resolve: yes
+    msg: Ansible task finished
+
+# Send a batch of messages.
+- wechat:
+    corpid: "123"
+    secret: "456"
+    agentid: "100001"
+    touser: "LeWork"
+    messages:
+      - "deploy started"
+      - msg: "web01 deployed"
+        toparty: "10"
+      - msg: "db01 deployed"
+        touser: "Lework1|Lework2"
 '''
 
 RETURN = """
@@ -105,6 +175,15 @@ totag:
   returned: success
   type: str
   sample: "dev"
+results:
+  description:
+    - Status of every message of messages, with errcode, errmsg, the invalid recipients Wechat reported
+      and how many times it was retried.
+    - Merged messages share the status of the merged send and carry coalesced, the number of messages merged.
+  returned: when messages is given
+  type: list
+  sample: [{"msg": "web01 deployed", "touser": "LeWork", "toparty": null, "totag": null, "sent": true,
+            "errcode": 0, "errmsg": "ok", "invaliduser": "Lework3", "retries": 0}]
 wechat_error:
   description: Error message gotten from Wechat API
   returned: failure
@@ -117,22 +196,318 @@ wechat_error:
 # WeChat module specific support methods.
 #
 
+import base64
+import fcntl
+import hashlib
 import json
+import os
+import random
+import socket
+import ssl
+import tempfile
+import threading
+import time
 import traceback
 
+from contextlib import contextmanager
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_native
+from ansible.module_utils._text import to_bytes, to_native
+from ansible.module_utils.six.moves import http_client, queue
+from ansible.module_utils.six.moves.urllib.parse import unquote, urlencode, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
 from ansible.module_utils.urls import fetch_url
 
+# access_token 缓存文件, 所有任务共享
+TOKEN_CACHE = os.path.expanduser(os.environ.get('ANSIBLE_WECHAT_TOKEN_CACHE', '~/.ansible/wechat/tokens.json'))
+# 过期前多少秒提前刷新
+TOKEN_REFRESH_MARGIN = 300
+# access_token 无效或过期的错误码
+INVALID_TOKEN_CODES = (40001, 40014, 42001)
+# 批量发送时每个连接的超时秒数
+HTTP_TIMEOUT = 10
+# 限流状态文件, 所有任务共享
+RATE_LIMIT_FILE = os.path.join(os.path.dirname(TOKEN_CACHE), 'ratelimit.json')
+# 每个企业每分钟调用发送接口的上限
+APP_RATE = 10000
+# 每个应用每分钟给同一个成员发送消息的上限, 超过的消息会被丢弃
+MEMBER_RATE = 30
+# 系统繁忙, 调用超过频率或并发限制, 退避后重试
+RETRY_CODES = (-1, 45009, 45033)
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+# 文本消息内容的最大字节数
+TEXT_LIMIT = 2048
+# 通讯录缓存, 保存部门和成员
+DIRECTORY_CACHE = os.path.join(os.path.dirname(TOKEN_CACHE), 'directory.json')
+
+
+@contextmanager
+def file_lock(path):
+    """
+    进程间的排他锁
+    :param path: 锁文件
+    :return:
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock.close()
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_json(path, data):
+    """
+    原子地写入 json 文件, 权限 0600
+    :param path: 文件路径
+    :param data: 内容
+    :return:
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def backoff(attempt):
+    """
+    指数退避加随机抖动
+    :param attempt: 第几次重试, 从 0 开始
+    :return: 等待秒数
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def coalesce(messages):
+    """
+    合并发给同一组接收人的消息, 合并后不超过文本消息的长度限制
+    :param messages: 消息列表
+    :return: [(原消息下标列表, 合并后的消息)]
+    """
+    groups = []
+    last = {}
+    for index, message in enumerate(messages):
+        key = (message.get('touser'), message.get('toparty'), message.get('totag'))
+        group = last.get(key)
+        if group is not None:
+            content = group[1]['msg'] + '\n' + message['msg']
+            if len(to_bytes(content, errors='surrogate_or_strict')) <= TEXT_LIMIT:
+                group[0].append(index)
+                group[1]['msg'] = content
+                continue
+        group = last[key] = ([index], dict(message))
+        groups.append(group)
+    return groups
+
+
+class RateLimiter(object):
+    """
+    令牌桶限流, 桶的状态保存在加锁的文件中, 所有进程和线程共享
+    """
+
+    def __init__(self, path=RATE_LIMIT_FILE):
+        self.path = path
+
+    def acquire(self, buckets):
+        """
+        从每个桶各取一个令牌, 不够时等待
+        :param buckets: [(桶名, 每分钟速率)]
+        :return: 等待的秒数
+        """
+        waited = 0
+        while True:
+            with file_lock(self.path + '.lock'):
+                state = load_json(self.path)
+                now = time.time()
+                levels = {}
+                wait = 0
+                for key, rate in buckets:
+                    entry = state.get(key)
+                    tokens = rate if entry is None else min(rate, entry['tokens'] + (now - entry['stamp']) * rate / 60.0)
+                    levels[key] = tokens
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) * 60.0 / rate)
+                if not wait:
+                    for key, rate in buckets:
+                        state[key] = {'tokens': levels[key] - 1, 'stamp': now, 'rate': rate}
+                    # 已经回满的桶不用保存
+                    state = dict((k, v) for k, v in state.items()
+                                 if v['tokens'] + (now - v['stamp']) * v['rate'] / 60.0 < v['rate'])
+                    save_json(self.path, state)
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+
+class TokenCache(object):
+    """
+    access_token 缓存, 按 corpid 和应用密钥的摘要保存, 文件权限 0600;
+    并发的 fork 通过文件锁串行获取, 只有一个会去请求 gettoken
+    """
+
+    def __init__(self, path=TOKEN_CACHE):
+        self.path = path
+        self.lock = None
+        self.tokens = {}
+
+    def __enter__(self):
+        self.lock = file_lock(self.path + '.lock')
+        self.lock.__enter__()
+        self.tokens = load_json(self.path)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.__exit__(*exc)
+
+    def get(self, key):
+        """
+        获取未过期的 token
+        :param key: 缓存键
+        :return: token, 没有或快要过期时返回 None
+        """
+        entry = self.tokens.get(key)
+        if entry and entry['expires'] - time.time() > TOKEN_REFRESH_MARGIN:
+            return entry['token']
+        return None
+
+    def put(self, key, token, expires_in):
+        """
+        保存 token, 同时清理过期的记录
+        :param key: 缓存键
+        :param token: access_token
+        :param expires_in: 有效秒数
+        :return:
+        """
+        now = time.time()
+        self.tokens = dict((k, v) for k, v in self.tokens.items() if v['expires'] > now)
+        self.tokens[key] = {'token': token, 'expires': now + expires_in}
+        save_json(self.path, self.tokens)
+
+
+class Directory(object):
+    """
+    通讯录缓存, 按 corpid 和应用保存部门和成员, 过期后重新获取;
+    用来把部门名和成员姓名解析成 id, 并在发送前检查接收人
+    """
+
+    def __init__(self, wechat, ttl=3600, path=DIRECTORY_CACHE):
+        self.wechat = wechat
+        self.ttl = ttl
+        self.path = path
+        self.departments = []
+        self.users = []
+        self.fetched = None
+        # 本次运行是否已经从企业微信获取过
+        self.refreshed = False
+
+    def load(self, refresh=False):
+        """
+        读取缓存, 不存在或过期时从企业微信获取
+        :param refresh: 忽略有效期重新获取
+        :return:
+        """
+        key = '%s:%s' % (self.wechat.corpid, self.wechat.agentid)
+        with file_lock(self.path + '.lock'):
+            state = load_json(self.path)
+            entry = state.get(key)
+            if entry is None:
+                fresh = False
+            elif refresh:
+                # 其他任务在本次读取之后已经刷新过
+                fresh = self.fetched is not None and entry['fetched'] > self.fetched
+            else:
+                fresh = time.time() - entry['fetched'] < self.ttl
+            if fresh:
+                self.departments, self.users = entry['departments'], entry['users']
+                self.fetched = entry['fetched']
+                return
+            self.refreshed = True
+            self.departments = self.wechat.get_department()
+            # 应用可见范围内的顶层部门, 连同子部门获取成员
+            ids = set(d['id'] for d in self.departments)
+            users = {}
+            for department in self.departments:
+                if department.get('parentid') not in ids:
+                    for user in self.wechat.get_department_user(department['id']):
+                        users[user['userid']] = {'userid': user['userid'], 'name': user.get('name')}
+            self.users = list(users.values())
+            self.fetched = time.time()
+            state[key] = {'fetched': self.fetched, 'departments': self.departments, 'users': self.users}
+            save_json(self.path, state)
+
+    def resolve(self, touser, toparty):
+        """
+        把成员姓名和部门名解析成 id, 有无法解析的接收人时重新获取一次通讯录, 新加入的成员不用等缓存过期
+        :param touser: 成员 id 或姓名, '|' 分隔
+        :param toparty: 部门 id 或部门名, '|' 分隔
+        :return: (touser, toparty, 无法解析的接收人)
+        """
+        result = self.lookup(touser, toparty)
+        if result[2] and not self.refreshed:
+            self.load(refresh=True)
+            self.refreshed = True
+            result = self.lookup(touser, toparty)
+        return result
+
+    def lookup(self, touser, toparty):
+        """
+        在当前通讯录中解析接收人
+        :param touser: 成员 id 或姓名, '|' 分隔
+        :param toparty: 部门 id 或部门名, '|' 分隔
+        :return: (touser, toparty, 无法解析的接收人)
+        """
+        userids = set(u['userid'] for u in self.users)
+        unknown = []
+        users = []
+        for item in (touser or '').split('|'):
+            if not item or item == '@all' or item in userids:
+                users.append(item)
+                continue
+            matches = [u['userid'] for u in self.users if u['name'] == item]
+            if len(matches) == 1:
+                users.append(matches[0])
+            else:
+                unknown.append("user %s%s" % (item, ' (ambiguous)' if matches else ''))
+        parties = []
+        for item in (toparty or '').split('|'):
+            ids = [str(d['id']) for d in self.departments if str(d['id']) == item]
+            if not item or ids:
+                parties.append(item)
+                continue
+            matches = [str(d['id']) for d in self.departments if d['name'] == item]
+            if len(matches) == 1:
+                parties.append(matches[0])
+            else:
+                unknown.append("department %s%s" % (item, ' (ambiguous)' if matches else ''))
+        return '|'.join(users) or None, '|'.join(parties) or None, unknown
+
 
 class WeChat(object):
-    def __init__(self, module, corpid, secret, agentid):
+    def __init__(self, module, corpid, secret, agentid, retries=5):
         """
         初始化
         :param module:  Ansible module
         :param corpid:  企业ID
         :param secret:  密钥
         :param agentid: 应用id
+        :param retries: 被限流或系统繁忙时的重试次数
         """
         self.module = module
         self.url = "https://qyapi.weixin.qq.com"
@@ -141,6 +516,9 @@ class WeChat(object):
         self.agentid = agentid
         self.token = ''
         self.msg = ''
+        self.token_lock = threading.Lock()
+        self.retries = retries
+        self.limiter = RateLimiter()
 
         if self.module.check_mode:
         # In check mode, exit before actually sending the message
@@ -148,20 +526,34 @@ class WeChat(object):
 
         self.access_token()
 
-    def access_token(self):
+    def access_token(self, refresh=False):
         """
-        获取企业微信的 access_token
+        获取企业微信的 access_token, 优先使用缓存
+        :param refresh: 当前 token 已失效, 强制刷新
         :return:
         """
-        url_arg = '/cgi-bin/gettoken?corpid={id}&corpsecret={crt}'.format(
-            id=self.corpid, crt=self.secret)
-        url = self.url + url_arg
-        response,info = fetch_url(self.module, url=url)
-        text = response.read()
-        try: 
-          self.token = json.loads(text)['access_token']
-        except:
-          raise Exception("Invalid corpid or corpsecret，api result:%s" % text)
+        key = '%s:%s' % (self.corpid, hashlib.sha256(
+            ('%s:%s' % (self.agentid, self.secret)).encode('utf-8')).hexdigest())
+        with TokenCache() as cache:
+            token = cache.get(key)
+            # 刷新时如果其它进程已经换了新的 token, 直接使用
+            if token and not (refresh and token == self.token):
+                self.token = token
+                return
+
+            url_arg = '/cgi-bin/gettoken?corpid={id}&corpsecret={crt}'.format(
+                id=self.corpid, crt=self.secret)
+            url = self.url + url_arg
+            response, info = fetch_url(self.module, url=url)
+            if response is None:
+                raise Exception("gettoken failed: %s" % info['msg'])
+            text = response.read()
+            try:
+                result = json.loads(text)
+                self.token = result['access_token']
+            except Exception:
+                raise Exception("Invalid corpid or corpsecret，api result:%s" % text)
+            cache.put(key, self.token, result.get('expires_in', 7200))
 
     def messages(self, msg, touser, toparty, totag):
         """
@@ -183,10 +575,11 @@ class WeChat(object):
             values['touser'] = touser
         if toparty:
             values['toparty'] = toparty
-        if toparty:
+        if totag:
             values['totag'] = totag
 
         self.msg = json.dumps(values)
+        return self.msg
 
     def send_message(self, msg, touser=None, toparty=None, totag=None):
         """
@@ -199,35 +592,242 @@ class WeChat(object):
         """
         self.messages(msg, touser, toparty, totag)
 
-        send_url = '{url}/cgi-bin/message/send?access_token={token}'.format(
-            url=self.url, token=self.token)
-        response,info = fetch_url(self.module,url=send_url, data=self.msg, method='POST')
-        text = json.loads(response.read())
-        if text['invaliduser'] != '' :
+        attempt = 0
+        refreshed = False
+        while True:
+            self.limiter.acquire(self.rate_buckets(touser))
+            send_url = '{url}/cgi-bin/message/send?access_token={token}'.format(
+                url=self.url, token=self.token)
+            response, info = fetch_url(self.module, url=send_url, data=self.msg, method='POST')
+            if response is None:
+                raise Exception("send failed: %s" % info['msg'])
+            text = json.loads(response.read())
+            errcode = text.get('errcode')
+            # token 被提前作废时刷新后重发一次
+            if errcode in INVALID_TOKEN_CODES and not refreshed:
+                self.access_token(refresh=True)
+                refreshed = True
+                continue
+            if errcode in RETRY_CODES and attempt < self.retries:
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+            break
+        if text.get('invaliduser'):
            raise Exception("invalid user: %s" % text['invaliduser'])
+        if errcode:
+            raise Exception("errcode %s: %s" % (errcode, text.get('errmsg')))
+
+    def rate_buckets(self, touser):
+        """
+        一条消息要占用的限流桶: 企业的接口调用频率和每个接收成员的消息频率
+        :param touser: 指定用户id
+        :return: [(桶名, 每分钟速率)]
+        """
+        buckets = [('send:%s' % self.corpid, APP_RATE)]
+        for user in (touser or '').split('|'):
+            if user and user != '@all':
+                buckets.append(('user:%s:%s:%s' % (self.corpid, self.agentid, user), MEMBER_RATE))
+        return buckets
+
+    def refresh_token(self, stale):
+        """
+        多个线程同时遇到 token 失效时只刷新一次
+        :param stale: 失效的 token
+        :return:
+        """
+        with self.token_lock:
+            if self.token == stale:
+                self.access_token(refresh=True)
+
+    def connect(self):
+        """
+        建立到企业微信的 HTTPS 长连接, 校验证书, 设置了 https_proxy 时经代理建立隧道
+        :return: HTTPSConnection, 无法校验证书或代理不支持时返回 None, 改用 fetch_url 发送
+        """
+        # access_token 在 URL 里, 不能使用不校验证书的连接
+        if not hasattr(ssl, 'create_default_context'):
+            return None
+        host = self.url.split('://', 1)[1]
+        context = ssl.create_default_context()
+        proxy = getproxies().get('https')
+        if not proxy or proxy_bypass(host):
+            return http_client.HTTPSConnection(host, timeout=HTTP_TIMEOUT, context=context)
+        proxy = urlparse(proxy)
+        if proxy.scheme != 'http' or not proxy.hostname:
+            return None
+        headers = {}
+        if proxy.username:
+            credentials = '%s:%s' % (unquote(proxy.username), unquote(proxy.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + to_native(base64.b64encode(to_bytes(credentials)))
+        conn = http_client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=HTTP_TIMEOUT, context=context)
+        conn.set_tunnel(host, 443, headers)
+        return conn
+
+    def post_url(self, path, body):
+        """
+        没有长连接时用 fetch_url 发送一个请求
+        :param path: 请求路径
+        :param body: 请求内容
+        :return: 返回的 json
+        """
+        response, info = fetch_url(self.module, url=self.url + path, data=body, method='POST',
+                                   headers={'Content-Type': 'application/json'}, timeout=HTTP_TIMEOUT)
+        if response is None:
+            raise Exception("send failed: %s" % info['msg'])
+        return json.loads(to_native(response.read()))
+
+    def post(self, conn, path, body):
+        """
+        在长连接上发送请求, 连接被服务端关闭时重连一次; 无法建立长连接时改用 fetch_url
+        :param conn: 当前连接, 可以为 None
+        :param path: 请求路径
+        :param body: 请求内容
+        :return: (连接, 返回的 json)
+        """
+        for attempt in range(2):
+            if conn is None:
+                conn = self.connect()
+            if conn is None:
+                return None, self.post_url(path, body)
+            try:
+                conn.request('POST', path, body, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                # 读完响应才能复用连接
+                data = response.read()
+                if response.status != 200:
+                    raise Exception("HTTP %s: %s" % (response.status, to_native(data)))
+                return conn, json.loads(to_native(data))
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                conn = None
+                if attempt:
+                    raise
+
+    def deliver(self, conn, message):
+        """
+        发送一条消息, 返回它的状态而不是抛出异常
+        :param conn: 当前连接
+        :param message: 消息, 包含 msg, touser, toparty, totag
+        :return: (连接, 消息状态)
+        """
+        status = dict(message, sent=False, retries=0)
+        body = self.messages(message['msg'], message.get('touser'), message.get('toparty'), message.get('totag'))
+        refreshed = False
+        try:
+            while True:
+                self.limiter.acquire(self.rate_buckets(message.get('touser')))
+                token = self.token
+                conn, result = self.post(conn, '/cgi-bin/message/send?access_token=%s' % token, body)
+                errcode = result.get('errcode')
+                if errcode in INVALID_TOKEN_CODES and not refreshed:
+                    self.refresh_token(token)
+                    refreshed = True
+                    continue
+                if errcode in RETRY_CODES and status['retries'] < self.retries:
+                    time.sleep(backoff(status['retries']))
+                    status['retries'] += 1
+                    continue
+                break
+        except Exception as e:
+            status['error'] = to_native(e)
+            return conn, status
+        for key in ('errcode', 'errmsg', 'invaliduser', 'invalidparty', 'invalidtag'):
+            if result.get(key) not in (None, ''):
+                status[key] = result[key]
+        status['sent'] = result.get('errcode') == 0
+        return conn, status
+
+    def send_messages(self, messages, concurrency=4, merge=False):
+        """
+        批量发送消息, 最多 concurrency 个线程, 每个线程复用一个长连接
+        :param messages: 消息列表
+        :param concurrency: 并发数
+        :param merge: 合并发给同一组接收人的消息
+        :return: 每条消息的状态, 与 messages 顺序一致
+        """
+        if merge:
+            groups = coalesce(messages)
+        else:
+            groups = [([index], message) for index, message in enumerate(messages)]
+        jobs = queue.Queue()
+        for group in groups:
+            jobs.put(group)
+        results = [None] * len(messages)
+
+        def worker():
+            conn = None
+            try:
+                while True:
+                    try:
+                        indexes, message = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    conn, status = self.deliver(conn, message)
+                    for index in indexes:
+                        results[index] = dict(status, msg=messages[index]['msg'])
+                        if len(indexes) > 1:
+                            results[index]['coalesced'] = len(indexes)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, min(concurrency, len(groups))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def api_get(self, path, **query):
+        """
+        调用企业微信的查询接口
+        :param path: 接口路径
+        :param query: 查询参数
+        :return: 返回的 json
+        """
+        for attempt in range(2):
+            token = self.token
+            url = '{url}{path}?{query}'.format(url=self.url, path=path,
+                                               query=urlencode(dict(query, access_token=token)))
+            response, info = fetch_url(self.module, url=url)
+            if response is None:
+                raise Exception("%s failed: %s" % (path, info['msg']))
+            result = json.loads(response.read())
+            if result.get('errcode') in INVALID_TOKEN_CODES and attempt == 0:
+                self.refresh_token(token)
+                continue
+            if result.get('errcode'):
+                raise Exception("%s errcode %s: %s" % (path, result['errcode'], result.get('errmsg')))
+            return result
 
     def get_department_user(self, did):
         """
-        获取部门成员列表
+        获取部门成员列表, 包含子部门; simplelist 没有分页, 一次返回全部成员
         :param did:  部门id
-        :return:
+        :return: 成员列表
         """
-        send_url = '{url}/cgi-bin/user/simplelist?access_token={token}&department_id={did}&fetch_child=1'.format(
-            url=self.url, token=self.token, did=did
-        )
-        response = requests.get(url=send_url)
-        print(response.json())
+        return self.api_get('/cgi-bin/user/simplelist', department_id=did, fetch_child=1)['userlist']
 
     def get_department(self):
         """
-        获取部门列表
-        :return:
+        获取应用可见范围内的部门列表
+        :return: 部门列表
         """
-        send_url = '{url}/cgi-bin/department/list?access_token={token}'.format(
-            url=self.url, token=self.token
-        )
-        response = requests.get(url=send_url)
-        print(response.json())
+        return self.api_get('/cgi-bin/department/list')['department']
+
+def load_directory(module, wechat):
+    """
+    需要解析接收人时加载通讯录
+    :param module: Ansible module
+    :param wechat: WeChat
+    :return: Directory 或 None
+    """
+    if not module.params["resolve"]:
+        return None
+    directory = Directory(wechat, module.params["directory_ttl"])
+    directory.load()
+    return directory
 
 
 def main():
@@ -236,11 +836,19 @@ def main():
             corpid=dict(required=True, type='str', no_log=True),
             secret=dict(required=True, type='str', no_log=True),
             agentid=dict(required=True, type='str'),
-            msg=dict(required=True, type='str'),
+            msg=dict(type='str'),
             touser=dict(type='str'),
             toparty=dict(type='str'),
             totag=dict(type='str'),
+            messages=dict(type='list'),
+            concurrency=dict(type='int', default=4),
+            retries=dict(type='int', default=5),
+            coalesce=dict(type='bool', default=False),
+            resolve=dict(type='bool', default=False),
+            directory_ttl=dict(type='int', default=3600),
         ),
+        required_one_of=[['msg', 'messages']],
+        mutually_exclusive=[['msg', 'messages']],
         supports_check_mode=True
     )
 
@@ -252,11 +860,51 @@ def main():
     toparty = module.params["toparty"]
     totag = module.params["totag"]
 
-    try:
-        if not touser and not toparty and not totag:
-            touser = "@all"
+    if not touser and not toparty and not totag:
+        touser = "@all"
+
+    if module.params["messages"] is not None:
+        # 没有指定接收人的消息发给模块参数中的接收人
+        messages = []
+        for item in module.params["messages"]:
+            if not isinstance(item, dict):
+                item = {'msg': item}
+            if not item.get('msg'):
+                module.fail_json(msg="every item of messages needs a msg")
+            if not item.get('touser') and not item.get('toparty') and not item.get('totag'):
+                item = dict(item, touser=touser, toparty=toparty, totag=totag)
+            messages.append(dict((k, item.get(k)) for k in ('msg', 'touser', 'toparty', 'totag')))
+        try:
+            wechat = WeChat(module, corpid, secret, agentid, module.params["retries"])
+            directory = load_directory(module, wechat)
+        except Exception as e:
+            module.fail_json(msg="unable to get access_token or directory", wechat_error=to_native(e),
+                             exception=traceback.format_exc())
+        # 接收人无法解析的消息不发送
+        rejected = {}
+        if directory is not None:
+            for index, message in enumerate(messages):
+                message['touser'], message['toparty'], unknown = directory.resolve(message['touser'],
+                                                                                   message['toparty'])
+                if unknown:
+                    rejected[index] = dict(message, sent=False, error="unknown recipients: %s" % ', '.join(unknown))
+        valid = [m for i, m in enumerate(messages) if i not in rejected]
+        sent = iter(wechat.send_messages(valid, module.params["concurrency"], module.params["coalesce"]))
+        results = [rejected[i] if i in rejected else next(sent) for i in range(len(messages))]
+        failed = [r for r in results if not r['sent']]
+        if failed:
+            module.fail_json(msg="%d of %d messages not sent" % (len(failed), len(results)),
+                             changed=len(failed) < len(results), results=results)
+        module.exit_json(changed=True, results=results)
 
-        wechat = WeChat(module, corpid, secret, agentid)
+    try:
+        wechat = WeChat(module, corpid, secret, agentid, module.params["retries"])
+        directory = load_directory(module, wechat)
+        if directory is not None:
+            touser, toparty, unknown = directory.resolve(touser, toparty)
+            if unknown:
+                module.fail_json(msg="unable to send msg: %s" % msg,
+                                 wechat_error="unknown recipients: %s" % ', '.join(unknown))
         wechat.send_message(msg, touser, toparty, totag)
 
     except Exception as e: